@@ -1,3 +1,10 @@
+from contextlib import contextmanager, nullcontext
+import json
+import math
+import time
+from collections import namedtuple
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
     def __init__(self, name, fmt=':f'):
@@ -19,4 +26,168 @@ class AverageMeter(object):
 
     def __str__(self):
         fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
-        return fmtstr.format(**self.__dict__)
\ No newline at end of file
+        return fmtstr.format(**self.__dict__)
+
+
+def _add_exact(partials, values):
+    # Shewchuk's algorithm: keep the sum of everything added so far exactly, as
+    # non-overlapping floats in increasing magnitude (as math.fsum does internally)
+    for x in values:
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i:] = [x]
+    return partials
+
+
+class MergeableAverageMeter(object):
+    """AverageMeter whose sum is kept exactly, so meters filled with different
+    parts of the values can be merged without any rounding difference.
+
+    The average is the correctly rounded sum divided by the count, whatever the
+    order or grouping of the updates and merges. It can therefore differ in the
+    last bits from the running sum of AverageMeter, and from numbers reported
+    with it.
+    """
+    def __init__(self, name, fmt=':f'):
+        self.name = name
+        self.fmt = fmt
+        self.reset()
+
+    def reset(self):
+        self.val = 0.0
+        self.partials = []
+        self.count = 0
+
+    @property
+    def sum(self):
+        return math.fsum(self.partials)
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def update(self, val, n):
+        self.val = val
+        _add_exact(self.partials, [val * n])
+        self.count += n
+
+    def merge(self, other):
+        _add_exact(self.partials, other.partials)
+        self.count += other.count
+
+    def state_dict(self):
+        # floats survive a json round trip exactly
+        return {"name": self.name, "partials": list(self.partials), "count": self.count}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        meter = cls(state["name"])
+        meter.partials = [float(p) for p in state["partials"]]
+        meter.count = state["count"]
+        return meter
+
+    def __str__(self):
+        fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
+        return fmtstr.format(name=self.name, val=self.val, avg=self.avg)
+
+
+class WHDRAverageMeter(object):
+    Result = namedtuple("Result", ["WHDR", "WHDR_eq", "WHDR_ineq"])
+
+    def __init__(self, name: str):
+        self.name = name
+        self.whdr_meter = MergeableAverageMeter("WHDR")
+        self.whdr_eq_meter = MergeableAverageMeter("WHDR_eq")
+        self.whdr_ineq_meter = MergeableAverageMeter("WHDR_ineq")
+
+    def update(self, whdr, whdr_eq, whdr_ineq, count, count_eq, count_ineq):
+        self.whdr_meter.update(whdr, count)
+        self.whdr_eq_meter.update(whdr_eq, count_eq)
+        self.whdr_ineq_meter.update(whdr_ineq, count_ineq)
+
+    def update_result(self, result):
+        """Add the metrics_iiw.whdr_from_sums result of one image"""
+        (whdr, _), (whdr_eq, valid_eq), (whdr_ineq, valid_ineq) = result
+        self.update(whdr,    whdr_eq if valid_eq else 0, whdr_ineq if valid_ineq else 0,
+                    1,       1 if valid_eq else 0,       1 if valid_ineq else 0)
+
+    def merge(self, other):
+        """Fold in the images of another WHDRAverageMeter, e.g. of another shard of the test list"""
+        self.whdr_meter.merge(other.whdr_meter)
+        self.whdr_eq_meter.merge(other.whdr_eq_meter)
+        self.whdr_ineq_meter.merge(other.whdr_ineq_meter)
+
+    def state_dict(self):
+        return {"name": self.name,
+                "meters": [m.state_dict() for m in [self.whdr_meter, self.whdr_eq_meter, self.whdr_ineq_meter]]}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        meter = cls(state["name"])
+        meter.whdr_meter, meter.whdr_eq_meter, meter.whdr_ineq_meter = \
+            [MergeableAverageMeter.from_state_dict(m) for m in state["meters"]]
+        return meter
+
+    def to_json(self):
+        return json.dumps(self.state_dict())
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_state_dict(json.loads(text))
+
+    def get_results(self):
+        return self.Result(WHDR=self.whdr_meter.avg, WHDR_eq=self.whdr_eq_meter.avg, WHDR_ineq=self.whdr_ineq_meter.avg)
+
+    def __str__(self):
+        return f"WHDR {self.whdr_meter.avg: .6f}, " \
+               f"WHDR_eq {self.whdr_eq_meter.avg: .6f}, " \
+               f"WHDR_ineq {self.whdr_ineq_meter.avg: .6f}"
+
+
+class StageTimer(object):
+    """Accumulates wall-clock time and call counts of named stages"""
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def merge(self, other):
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + other.counts[name]
+
+    def __str__(self):
+        return ", ".join(f"{name} {seconds:.3f}s/{self.counts[name]}" for name, seconds in self.seconds.items())
+
+
+class NullTimer(object):
+    """StageTimer stand-in that records nothing"""
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def merge(self, other):
+        pass
+
+    def __str__(self):
+        return ""
+
+
+null_timer = NullTimer()
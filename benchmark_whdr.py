@@ -0,0 +1,209 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import h5py
+import numpy as np
+from skimage.transform import resize
+
+import metrics_iiw
+import util
+from compute_iiw_whdr import evaluate_predictions
+from image_meta import ImageSizeIndex
+from judgement_store import JudgementStore
+from prediction_loader import Li_2018_CGI_Loader, Luo_2020_NIID_Net_Loader
+
+
+def make_judgements(rng, num_points, num_comparisons):
+    """Random judgements in the IIW json format"""
+    points = [{"id": int(i), "x": float(rng.random()), "y": float(rng.random()), "opaque": bool(rng.random() > 0.02)}
+              for i in range(num_points)]
+    comparisons = []
+    for _ in range(num_comparisons):
+        p1, p2 = rng.choice(num_points, 2, replace=False)
+        comparisons.append({"point1": int(p1), "point2": int(p2),
+                            "darker": str(rng.choice(["1", "2", "E"])),
+                            "darker_score": float(rng.random() * 1.5)})
+    return {"intrinsic_points": points, "intrinsic_comparisons": comparisons}
+
+
+def make_dataset(root, num_images, num_points, num_comparisons, pred_shape, original_shape, seed=0):
+    """Write synthetic judgements, input images and predictions laid out like the IIW
+    dataset and the Li 2018 / Luo 2020 result folders, and a 3-bucket test list
+    `test_list.p` of them. Returns the image ids."""
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(root, "data")
+    li_dir = os.path.join(root, "li", "release_iiw")
+    luo_dir = os.path.join(root, "luo", "final_raw")
+    for d in [data_dir, li_dir, luo_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    ids = [str(100000 + i) for i in range(num_images)]
+    for id in ids:
+        with open(os.path.join(data_dir, f"{id}.json"), "w") as f:
+            json.dump(make_judgements(rng, num_points, num_comparisons), f)
+        cv2.imwrite(os.path.join(data_dir, f"{id}.png"), np.zeros(tuple(original_shape) + (3,), dtype=np.uint8))
+        pred = rng.random(tuple(pred_shape) + (3,), dtype=np.float32)
+        with h5py.File(os.path.join(li_dir, f"{id}.png.h5"), "w") as f:
+            f.create_dataset("/prediction/R", data=pred)
+        np.save(os.path.join(luo_dir, f"{id}-r.npy"), pred)
+    with open(os.path.join(root, "test_list.p"), "wb") as f:
+        pickle.dump([[f"test_img/{id}.png.h5" for id in bucket] for bucket in np.array_split(ids, 3)], f)
+    return ids
+
+
+def run_stage(items, fn, num_comparisons, measure_memory=True, keep_outputs=False, num_images=None):
+    """Time fn over items and, in a second pass, measure its peak traced allocation.
+    `num_images` is the number of images fn covers in total, by default one per item."""
+    outputs = []
+    start = time.perf_counter()
+    for item in items:
+        output = fn(item)
+        if keep_outputs:
+            outputs.append(output)
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if measure_memory:
+        tracemalloc.start()
+        for item in items:
+            tracemalloc.reset_peak()
+            fn(item)
+            peak = max(peak or 0, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    num_images = len(items) if num_images is None else num_images
+    result = {
+        "seconds": seconds,
+        "images_per_sec": num_images / seconds if seconds > 0 else None,
+        "comparisons_per_sec": num_comparisons / seconds if seconds > 0 else None,
+        "peak_memory_bytes": peak,
+    }
+    return result, outputs
+
+
+def run_benchmark(root, ids, original_shape, eq_delta=0.1, measure_memory=True):
+    data_dir = os.path.join(root, "data")
+    li_loader = Li_2018_CGI_Loader(os.path.join(root, "li"))
+    luo_loader = Luo_2020_NIID_Net_Loader(os.path.join(root, "luo"))
+
+    def parse(id):
+        with open(os.path.join(data_dir, f"{id}.json")) as f:
+            return metrics_iiw.compile_judgements(json.load(f))
+
+    stages = {}
+    judgements = [parse(id) for id in ids]
+    num_comparisons = sum(len(j.weight) for j in judgements)
+
+    stages["json_parse"], _ = run_stage(ids, parse, num_comparisons, measure_memory)
+
+    store = JudgementStore(data_dir, os.path.join(root, "judgements_cache.npz"), verbose=False)
+    stages["judgement_store"], _ = run_stage(ids, store.get, num_comparisons, measure_memory)
+
+    stages["load_h5"], _ = run_stage(ids, lambda id: li_loader.get_pred_r(id, "srgb"),
+                                     num_comparisons, measure_memory)
+    stages["load_npy"], raw = run_stage(ids, lambda id: np.load(luo_loader.get_pred_r_path(id)),
+                                        num_comparisons, measure_memory, keep_outputs=True)
+    stages["srgb"], preds = run_stage(raw, util.rgb_to_srgb, num_comparisons, measure_memory, keep_outputs=True)
+    # the lookup table mode is meant for 8 bit sources such as decoded PNGs
+    raw_uint8 = [np.uint8(np.clip(p, 0.0, 1.0) * 255) for p in raw]
+    del raw
+    stages["srgb_lut_uint8"], _ = run_stage(raw_uint8, util.quantized_rgb_to_srgb,
+                                            num_comparisons, measure_memory)
+    del raw_uint8
+
+    resize_fn = lambda p: resize(p, original_shape, order=1, preserve_range=True, anti_aliasing=True)
+    stages["resize"], _ = run_stage(preds, resize_fn, num_comparisons, measure_memory)
+
+    # judgement coordinates are relative, so one resized map serves every image
+    resized = [resize_fn(preds[0])] * len(preds)
+    stages["whdr"], _ = run_stage(list(zip(resized, judgements)),
+                                  lambda item: metrics_iiw.compute_whdr(item[0], item[1], eq_delta),
+                                  num_comparisons, measure_memory)
+    del resized
+    stages["whdr_sparse"], _ = run_stage(
+        list(zip(preds, judgements)),
+        lambda item: metrics_iiw.compute_whdr_sparse(item[0], original_shape, item[1], eq_delta,
+                                                     anti_aliasing=True),
+        num_comparisons, measure_memory)
+
+    # the whole command line evaluation of one method: test list, judgement store,
+    # image size index, loading, scoring and aggregation, without its progress output
+    image_sizes = ImageSizeIndex(os.path.join(root, "image_sizes.json"))
+    for sparse in [False, True]:
+        def evaluate(list_path):
+            with contextlib.redirect_stdout(io.StringIO()):
+                return evaluate_predictions(list_path, root, eq_delta, li_loader, store, sparse=sparse,
+                                            image_sizes=image_sizes)
+        name = "evaluate_predictions_sparse" if sparse else "evaluate_predictions"
+        stages[name], _ = run_stage([os.path.join(root, "test_list.p")], evaluate, num_comparisons,
+                                    measure_memory, num_images=len(ids))
+    return stages, num_comparisons
+
+
+def measure_import_time(module, repeats=5):
+    """Median seconds to import `module` in a fresh interpreter, i.e. the cold-start
+    cost of a command line tool before it does any work"""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    times = [float(subprocess.run([sys.executable, "-c", code], cwd=repo_dir, check=True,
+                                  capture_output=True, text=True).stdout)
+             for _ in range(repeats)]
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the WHDR evaluation on synthetic data")
+    parser.add_argument("--images", default=50, type=int, help="Number of synthetic images")
+    parser.add_argument("--points", default=100, type=int, help="Judgement points per image")
+    parser.add_argument("--comparisons", default=170, type=int, help="Comparisons per image")
+    parser.add_argument("--pred_size", default=[256, 384], nargs=2, type=int, metavar=("H", "W"),
+                        help="Prediction resolution")
+    parser.add_argument("--orig_size", default=[341, 512], nargs=2, type=int, metavar=("H", "W"),
+                        help="Original image resolution the predictions are resized to")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--no_memory", action="store_true", help="Skip the tracemalloc peak memory pass")
+    parser.add_argument("--import_modules", default="compute_iiw_whdr,html", metavar="LIST", type=str,
+                        help="Comma list of modules whose cold-start import time is measured (empty to skip)")
+    parser.add_argument("--out", default=None, metavar="FILE", type=str, help="Write the results as json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        ids = make_dataset(root, args.images, args.points, args.comparisons, args.pred_size, args.orig_size,
+                           args.seed)
+        stages, num_comparisons = run_benchmark(root, ids, tuple(args.orig_size),
+                                                measure_memory=not args.no_memory)
+
+    print(f"{'stage':<28} {'seconds':>10} {'images/s':>12} {'comparisons/s':>15} {'peak MB':>10}")
+    for name, r in stages.items():
+        peak = f"{r['peak_memory_bytes'] / 2 ** 20:.2f}" if r["peak_memory_bytes"] is not None else "-"
+        print(f"{name:<28} {r['seconds']:>10.4f} {r['images_per_sec'] or 0:>12.1f} "
+              f"{r['comparisons_per_sec'] or 0:>15.0f} {peak:>10}")
+
+    import_times = {module: measure_import_time(module) for module in args.import_modules.split(',') if module}
+    if import_times:
+        print(f"\n{'module':<28} {'import s':>10}")
+        for module, seconds in import_times.items():
+            print(f"{module:<28} {seconds:>10.4f}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({
+                "config": vars(args),
+                "num_comparisons": num_comparisons,
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "stages": stages,
+                "import_seconds": import_times,
+            }, f, indent=2)
+        print(f"Results written to {args.out}")
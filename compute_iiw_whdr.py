@@ -1,81 +1,175 @@
-import numpy as np
-import pickle
-import sys
 import json
-import h5py
 import argparse
 import os
-from collections import namedtuple
-from skimage.transform import resize
-from skimage import io
+import tracemalloc
 
-from average_meter import AverageMeter
-from prediction_loader import *
-import metrics_iiw
+from average_meter import StageTimer, WHDRAverageMeter, null_timer
+from prediction_loader import PredictionLoader
+from judgement_store import JudgementStore
+import image_cache
+from iiw_export import ExportErrorCheck, export_loaders, read_export
+from image_meta import ImageSizeIndex
+from loader_registry import LoaderRegistry
+from result_store import ResultStore
+from whdr_bootstrap import BootstrapCollector, print_bootstrap_report
+from whdr_pipeline import aggregate_stage, evaluate_stream, read_ids
 
 
-class WHDRAverageMeter(object):
-    Result = namedtuple("Result", ["WHDR", "WHDR_eq", "WHDR_ineq"])
+def parse_thresholds(text):
+    """Parse "0.1", a list "0.05,0.1,0.2" or an inclusive range "0.05:0.3:0.05"."""
+    if ':' in text:
+        start, stop, step = [float(v) for v in text.split(':')]
+        num = int(round((stop - start) / step)) + 1
+        return [round(start + k * step, 10) for k in range(num)]
+    return [float(v) for v in text.split(',')]
 
-    def __init__(self, name: str):
-        self.name = name
-        self.whdr_meter = AverageMeter("WHDR")
-        self.whdr_eq_meter = AverageMeter("WHDR_eq")
-        self.whdr_ineq_meter = AverageMeter("WHDR_ineq")
 
-    def update(self, whdr, whdr_eq, whdr_ineq, count, count_eq, count_ineq):
-        self.whdr_meter.update(whdr, count)
-        self.whdr_eq_meter.update(whdr_eq, count_eq)
-        self.whdr_ineq_meter.update(whdr_ineq, count_ineq)
+def print_results_table(results):
+    """Print {method: {threshold: WHDRAverageMeter.Result}} as one comparison table"""
+    width = max([len("method")] + [len(name) for name in results])
+    print(f"{'method':<{width}} {'threshold':>10} {'WHDR':>10} {'WHDR_eq':>10} {'WHDR_ineq':>10}")
+    for name, method_results in results.items():
+        for delta, r in method_results.items():
+            print(f"{name:<{width}} {delta:>10.4f} {r.WHDR:>10.6f} {r.WHDR_eq:>10.6f} {r.WHDR_ineq:>10.6f}")
 
-    def get_results(self):
-        return self.Result(WHDR=self.whdr_meter.avg, WHDR_eq=self.whdr_eq_meter.avg, WHDR_ineq=self.whdr_ineq_meter.avg)
 
-    def __str__(self):
-        return f"WHDR {self.whdr_meter.avg: .6f}, " \
-               f"WHDR_eq {self.whdr_eq_meter.avg: .6f}, " \
-               f"WHDR_ineq {self.whdr_ineq_meter.avg: .6f}"
+def save_meters(path, meters, deltas):
+    """Write the {name: [WHDRAverageMeter per threshold in `deltas`]} `meters` as json"""
+    state = {name: [[delta, m.state_dict()] for delta, m in zip(deltas, method_meters)]
+             for name, method_meters in meters.items()}
+    with open(path, "w") as f:
+        json.dump(state, f)
 
 
-def evaluate_predictions(file_list_path, iiw_dir, eq_delta, loader: PredictionLoader):
-    images_list = pickle.load(open(file_list_path, "rb"))
+def merge_meter_files(paths):
+    """Merge the meters written by save_meters for shards of the test list, in the
+    given order. The averages equal those of a single run over all shards.
+    Returns {name: {threshold: WHDRAverageMeter.Result}}.
+    """
+    merged = {}
+    for path in paths:
+        with open(path) as f:
+            state = json.load(f)
+        for name, method_meters in state.items():
+            for delta, meter_state in method_meters:
+                meter = WHDRAverageMeter.from_state_dict(meter_state)
+                if (name, delta) in merged:
+                    merged[(name, delta)].merge(meter)
+                else:
+                    merged[(name, delta)] = meter
+    results = {}
+    for (name, delta), meter in merged.items():
+        results.setdefault(name, {})[delta] = meter.get_results()
+    return results
 
-    # whdr_rgb_meter = WHDRAverageMeter("whdr_rgb")
-    whdr_srgb_meter = WHDRAverageMeter("whdr_srgb")
-    # count = 0.0
-    # whdr_sum =0.0
 
+def read_test_ids(file_list_path):
+    """(bucket, index, id) for every image of the 3-bucket test list pickle"""
+    import pickle
+    images_list = pickle.load(open(file_list_path, "rb"))
+    ids = []
     for j in range(0, 3):
         img_list = images_list[j]
         for i in range(len(img_list)):
             id = str(img_list[i].split('/')[-1][0:-7])
-            img_path = os.path.join(iiw_dir, "data", f"{id}.png")
-            judgement_path = os.path.join(iiw_dir, "data", f"{id}.json")
-            judgements = json.load(open(judgement_path))
-
-            img = np.float32(io.imread(img_path)) / 255.0
-            o_h, o_w = img.shape[0], img.shape[1]
-
-            pred_r = loader.get_pred_r(id, "srgb")
-            pred_r = resize(pred_r, (o_h, o_w),
-                            order=1, preserve_range=True, anti_aliasing=True)
-
-            (whdr, _), (whdr_eq, valid_eq), (whdr_ineq, valid_ineq) =\
-                metrics_iiw.compute_whdr(pred_r, judgements, eq_delta)
-            # whdr_sum += whdr
-            # count+=1.0
-            # whdr_mean =whdr_sum/count
-            # print(whdr_mean)
-            whdr_srgb_meter.update(whdr,    whdr_eq if valid_eq else 0, whdr_ineq if valid_ineq else 0,
-                                   1,       1 if valid_eq else 0,       1 if valid_ineq else 0)
-            if i%100 == 0:
-                print(f"Evaluate {j}-{i}: \n"
-                      # f"\tWHDR(rgb) {whdr_rgb_meter} \n"
-                      f"\tWHDR(srgb) {whdr_srgb_meter}")
-
-    # whdr_mean = whdr_sum/count
-    # print('whdr_mean %f', whdr_mean)
-    print(f"\nWHDR(srgb) {whdr_srgb_meter}")
+            ids.append((j, i, id))
+    return ids
+
+
+def evaluate_methods(file_list_path, iiw_dir, eq_delta, loaders, judgement_store=None,
+                     sparse=False, num_workers=1, image_sizes=None, result_store=None, prefetch=0,
+                     timer=None, meters_path=None, on_result=None, keep_errors=False, space="srgb"):
+    """Evaluate every loader of the {name: loader} dict `loaders` on the test list.
+
+    `eq_delta` is one equality threshold or a list of them; every method and
+    threshold is scored from the same judgement and input loads. With
+    num_workers > 1 the images are scored by a process pool; results are still
+    accumulated in test list order, so the averages are identical to a serial run.
+    With a ResultStore, per-image results are saved to it and only the images
+    whose prediction or judgement file changed since the last run are scored
+    again. In a serial run, prefetch > 0 reads that many images ahead on
+    background threads. A StageTimer `timer` collects the time spent in each
+    stage, including the worker processes, and is printed with the progress. The
+    meters are written to `meters_path` if given, see merge_meter_files. See
+    evaluate_ids for on_result, keep_errors and space.
+    Returns {name: {threshold: WHDRAverageMeter.Result}}.
+    """
+    ids = [id for _, _, id in read_test_ids(file_list_path)]
+    if image_sizes is not None and num_workers > 1:
+        # fill and persist the index up front, worker processes only read it
+        for id in ids:
+            image_sizes.get(id, os.path.join(iiw_dir, "data", f"{id}.png"))
+        image_sizes.save()
+    return evaluate_ids(ids, iiw_dir, eq_delta, loaders, judgement_store, sparse=sparse, num_workers=num_workers,
+                        image_sizes=image_sizes, timer=timer, meters_path=meters_path, on_result=on_result,
+                        keep_errors=keep_errors, space=space, result_store=result_store, prefetch=prefetch)
+
+
+def evaluate_predictions(file_list_path, iiw_dir, eq_delta, loader: PredictionLoader, judgement_store=None,
+                         sparse=False, num_workers=1, image_sizes=None, result_store=None, prefetch=0,
+                         timer=None, name="srgb"):
+    """evaluate_methods for a single loader, returning {threshold: WHDRAverageMeter.Result}"""
+    return evaluate_methods(file_list_path, iiw_dir, eq_delta, {name: loader}, judgement_store,
+                            sparse=sparse, num_workers=num_workers, image_sizes=image_sizes,
+                            result_store=result_store, prefetch=prefetch, timer=timer)[name]
+
+
+def evaluate_ids(ids, iiw_dir, eq_delta, loaders, judgement_store=None, sparse=False, num_workers=1,
+                 image_sizes=None, timer=None, meters_path=None, on_result=None, keep_errors=False, space="srgb",
+                 result_store=None, prefetch=0):
+    """evaluate_methods over any iterable of image ids, e.g. whdr_pipeline.read_ids of a
+    text file or stdin, streamed through whdr_pipeline so the list is never materialized.
+    `on_result` is called with every whdr_pipeline.ImageResult, e.g. to collect them
+    for whdr_bootstrap; keep_errors adds the per comparison errors to them. The
+    predictions are scored in color `space`.
+    Returns {name: {threshold: WHDRAverageMeter.Result}}.
+    """
+    deltas = list(eq_delta) if isinstance(eq_delta, (list, tuple)) else [eq_delta]
+    whdr_srgb_meters = {name: [WHDRAverageMeter(f"{name}_whdr_srgb_{delta}") for delta in deltas]
+                        for name in loaders}
+    if timer is None:
+        timer = null_timer
+
+    results = evaluate_stream(ids, iiw_dir, deltas, loaders, judgement_store, sparse, image_sizes,
+                              num_workers=num_workers, timer=timer, keep_errors=keep_errors, space=space,
+                              result_store=result_store, prefetch=prefetch)
+    num_stored = num_scored = 0
+    num_skipped = {name: 0 for name in loaders}
+    for i, result in enumerate(aggregate_stage(results, whdr_srgb_meters)):
+        num_stored += len(result.stored)
+        num_scored += len(result.sums) - len(result.stored)
+        for name in result.skipped:
+            num_skipped[name] += 1
+        if on_result is not None:
+            on_result(result)
+        if i%100 == 0:
+            print(f"Evaluate {i} ({result.id}):")
+            for name, meters in whdr_srgb_meters.items():
+                for delta, whdr_srgb_meter in zip(deltas, meters):
+                    print(f"\t{name} WHDR({space}, t={delta}) {whdr_srgb_meter}")
+            if timer is not null_timer:
+                print(f"\tTiming: {timer}")
+    if image_sizes is not None:
+        image_sizes.save()
+    if result_store is not None:
+        result_store.save()
+        print(f"Reused {num_stored} stored results, scored {num_scored}")
+    if meters_path is not None:
+        save_meters(meters_path, whdr_srgb_meters, deltas)
+    for name, n in num_skipped.items():
+        if n > 0:
+            print(f"Skipped {n} images without a prediction file of {name}")
+
+    results = {name: {delta: m.get_results() for delta, m in zip(deltas, meters)}
+               for name, meters in whdr_srgb_meters.items()}
+    if len(loaders) == 1 and len(deltas) == 1:
+        print(f"\nWHDR({space}) {next(iter(whdr_srgb_meters.values()))[0]}")
+    else:
+        print(f"\nWHDR({space})")
+        print_results_table(results)
+    if timer is not null_timer:
+        print(f"\nTiming: {timer}")
+    return results
 
 
 if __name__ == '__main__':
@@ -87,6 +181,14 @@ if __name__ == '__main__':
         help="Path to test list file",
         type=str,
     )
+    parser.add_argument(
+        "--ids",
+        default=None,
+        metavar="FILE",
+        help="Image ids to stream instead of the test list: a text file with one id or path per line, "
+             "a test list pickle or - for stdin",
+        type=str,
+    )
     parser.add_argument(
         "--iiwdir",
         default="./data/iiw-dataset",
@@ -98,34 +200,250 @@ if __name__ == '__main__':
         "--method",
         default="Li_2018_full",
         metavar="FILE",
-        help="Method to be evaluated",
+        help="Method to be evaluated, a comma separated list of methods, \"all\" or \"export\" (see --export)",
         type=str,
     )
     parser.add_argument(
         "--t",
-        default=0.10,
+        default="0.10",
         metavar="Number",
-        help="Equality threshold",
+        help="Equality threshold, a comma separated list of them or an inclusive range start:stop:step",
+        type=parse_thresholds,
+    )
+    parser.add_argument(
+        "--judgement_cache",
+        default=None,
+        metavar="FILE",
+        help="Path to the compiled judgement cache (default: <iiwdir>/data/judgements_cache.npz)",
+        type=str,
+    )
+    parser.add_argument(
+        "--image_size_index",
+        default=None,
+        metavar="FILE",
+        help="Path to the persisted image size index (default: <iiwdir>/image_sizes.json)",
+        type=str,
+    )
+    parser.add_argument(
+        "--result_store",
+        default=None,
+        metavar="FILE",
+        help="Columnar file (.npz) of per-image results; only changed predictions and judgements are rescored",
+        type=str,
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        metavar="N",
+        help="Number of worker processes",
+        type=int,
+    )
+    parser.add_argument(
+        "--prefetch",
+        default=0,
+        metavar="N",
+        help="Number of images read ahead on background threads (serial runs only)",
+        type=int,
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="Report the cumulative time of each evaluation stage",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="FILE",
+        help="Write a cProfile dump (pstats format) of the main process to FILE",
+        type=str,
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Report the peak traced memory of the main process",
+    )
+    parser.add_argument(
+        "--meters_out",
+        default=None,
+        metavar="FILE",
+        help="Write the aggregated meters as json, to be merged with those of other shards",
+        type=str,
+    )
+    parser.add_argument(
+        "--merge",
+        default=None,
+        nargs="+",
+        metavar="FILE",
+        help="Print the results of the --meters_out files of several shards merged in order, and exit",
+        type=str,
+    )
+    parser.add_argument(
+        "--bootstrap",
+        default=0,
+        metavar="N",
+        help="Report bootstrap confidence intervals and paired p-values from N resamples of the images",
+        type=int,
+    )
+    parser.add_argument(
+        "--bootstrap_comparisons",
+        action="store_true",
+        help="Resample the comparisons within every drawn image as well, anew for every time it is "
+             "drawn (with --bootstrap); about 45 s for 10000 resamples of the full test split",
+    )
+    parser.add_argument(
+        "--seed",
+        default=0,
+        metavar="N",
+        help="Seed of the bootstrap resampling",
+        type=int,
+    )
+    parser.add_argument(
+        "--loaders",
+        default=None,
+        metavar="FILE",
+        help="Json {method: {\"class\": loader class, \"path\": result dir, \"options\": {...}}} "
+             "replacing the built-in methods; relative paths are resolved against the file",
+        type=str,
+    )
+    parser.add_argument(
+        "--export",
+        default=None,
+        metavar="FILE",
+        help="intrinsic-decompositions-export.json; every algorithm downloaded next to it becomes a method "
+             "(selected by \"all\" or \"export\") and the per-image WHDR is checked against its mean_error",
+        type=str,
+    )
+    parser.add_argument(
+        "--export_dir",
+        default=None,
+        metavar="DIR",
+        help="Directory of the downloaded algorithms (default: the directory of --export)",
+        type=str,
+    )
+    parser.add_argument(
+        "--space",
+        default="srgb",
+        choices=["srgb", "rgb"],
+        help="Color space the predictions are scored in; the export mean_error is for \"rgb\", "
+             "which only the image-backed loaders, e.g. those of --export, support",
+        type=str,
+    )
+    parser.add_argument(
+        "--image_cache",
+        default=None,
+        metavar="DIR",
+        help="Directory of the on-disk cache of decoded prediction images (default: in memory only)",
+        type=str,
+    )
+    parser.add_argument(
+        "--image_cache_size",
+        default=8.0,
+        metavar="GB",
+        help="Size limit of the --image_cache directory, least recently used images are evicted",
         type=float,
     )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="Interpolate predictions at the judgement points only instead of resizing them",
+    )
 
     args = parser.parse_args()
-    print(f"\ntest list file path:{args.file} ")
+    if args.prefetch > 0 and args.workers > 1:
+        parser.error("--prefetch only applies to serial runs, every worker process loads its own images")
+    if args.result_store is not None and args.bootstrap > 0 and args.bootstrap_comparisons:
+        parser.error("--bootstrap_comparisons needs the per comparison errors, which --result_store does not keep")
+    if args.merge is not None:
+        print_results_table(merge_meter_files(args.merge))
+        exit(0)
+    print(f"\ntest list file path:{args.file if args.ids is None else args.ids} ")
     print(f"IIW image directory: {args.iiwdir}")
-    for p in [args.file, args.iiwdir]:
-        if not os.path.exists(p):
+    for p in [args.file if args.ids is None else args.ids, args.iiwdir]:
+        if p != "-" and not os.path.exists(p):
             print(f"Not exsists: {p}")
             exit(0)
 
-    loader_dicts = {
-        "Li_2018_full": Li_2018_CGI_Loader("./Li_2018_CGIntrinsics/CGI+IIW+SAW/cgi_iiw"),
-        "Li_2018_cgi": Li_2018_CGI_Loader("./Li_2018_CGIntrinsics/CGI/cgi_iiw"),
-        "Luo_2020": Luo_2020_NIID_Net_Loader("./Luo_2020_NIID-Net")
-    }
-    if args.method not in loader_dicts.keys():
-        print(f"Undefined method: {args.method}")
+    # loaders are only constructed for the methods that are evaluated
+    loader_dicts = LoaderRegistry.from_file(args.loaders) if args.loaders is not None else LoaderRegistry()
+    if args.image_cache is not None:
+        image_cache.set_default_cache(image_cache.DiskImageCache(args.image_cache,
+                                                                 int(args.image_cache_size * 2 ** 30)))
+    export_check = None
+    if args.export is not None:
+        algorithms = read_export(args.export)
+        export_methods = export_loaders(algorithms, args.export_dir if args.export_dir is not None
+                                        else os.path.dirname(os.path.abspath(args.export)))
+        print(f"Downloaded algorithms: {', '.join(export_methods)}")
+        for name, loader in export_methods.items():
+            loader_dicts.register(name, loader)
+        export_check = ExportErrorCheck(algorithms, args.t)
+        del algorithms
+    if args.method == "export":
+        methods = list(export_methods) if args.export is not None else []
+    else:
+        methods = list(loader_dicts) if args.method == "all" else args.method.split(',')
+    if not methods:
+        print("No methods to evaluate")
+        exit(0)
+    for method in methods:
+        if method not in loader_dicts:
+            print(f"Undefined method: {method}")
+            exit(0)
+    unsupported = [method for method in methods if args.space not in loader_dicts[method].spaces]
+    if unsupported:
+        parser.error(f"--space {args.space} is not supported by {', '.join(unsupported)}; "
+                     f"select the export algorithms with --method export")
+
+    judgement_store = JudgementStore(os.path.join(args.iiwdir, "data"), args.judgement_cache)
+    image_sizes = ImageSizeIndex(args.image_size_index if args.image_size_index is not None
+                                 else os.path.join(args.iiwdir, "image_sizes.json"))
+
+    print(f"\nEvaluate {', '.join(methods)} with threshold: {', '.join(str(t) for t in args.t)}")
+    if args.tracemalloc:
+        tracemalloc.start()
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # the bootstrap and the export check need the per-image results, which the
+    # streaming evaluation hands out
+    collector = BootstrapCollector(args.t, judgement_store, methods) if args.bootstrap > 0 else None
+    callbacks = [c.add for c in [collector, export_check] if c is not None]
+
+    def on_result(result):
+        for callback in callbacks:
+            callback(result)
+
+    result_store = ResultStore(args.result_store) if args.result_store is not None else None
+    if args.ids is not None:
+        evaluate_ids(read_ids(args.ids), args.iiwdir, args.t if len(args.t) > 1 else args.t[0],
+                     {method: loader_dicts[method] for method in methods}, judgement_store,
+                     sparse=args.sparse, num_workers=args.workers, image_sizes=image_sizes,
+                     timer=StageTimer() if args.timing else None, meters_path=args.meters_out,
+                     on_result=on_result, keep_errors=args.bootstrap > 0 and args.bootstrap_comparisons,
+                     space=args.space, result_store=result_store, prefetch=args.prefetch)
+    else:
+        evaluate_methods(args.file, args.iiwdir, args.t if len(args.t) > 1 else args.t[0],
+                         {method: loader_dicts[method] for method in methods}, judgement_store,
+                         sparse=args.sparse, num_workers=args.workers, image_sizes=image_sizes,
+                         result_store=result_store, prefetch=args.prefetch,
+                         timer=StageTimer() if args.timing else None, meters_path=args.meters_out,
+                         on_result=on_result, keep_errors=args.bootstrap > 0 and args.bootstrap_comparisons,
+                         space=args.space)
+
+    if collector is not None:
+        print_bootstrap_report(collector, args.bootstrap, args.bootstrap_comparisons, args.seed)
+    if export_check is not None:
+        export_check.report()
 
-    print(f"\nEvaluate {args.method} with threshold: {args.t}")
-    evaluate_predictions(args.file, args.iiwdir, args.t, loader_dicts[args.method])
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile written to {args.profile}")
+    if args.tracemalloc:
+        print(f"Peak traced memory: {tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f} MB")
+        tracemalloc.stop()
 
 
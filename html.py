@@ -2,21 +2,23 @@
 
 from collections import namedtuple
 import os
-import pickle
 import shutil
-import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import dominate
-from dominate import tags
-from dominate.tags import meta, h2, tr, td, a, img, br, col, style
-import cv2
-
-from prediction_loader import *
+from prediction_loader import (Bi_2015_L1smoothing_Loader, CRefNet, General_Loader, InputLoader, Li_2018_CGI_Loader,
+                               Luo_2020_NIID_Net_Loader, Wang_2019_Discriminative_Loader)
+from image_meta import read_image_size
 
 
 Method = namedtuple("Method", ["title", "subdir", "image_loader"])
 
 
+def _dominate():
+    # dominate is imported on first use, to keep importing this module cheap
+    import dominate.tags
+    return dominate
+
+
 class HTML:
     """This HTML class allows us to save images and write texts into a single HTML file.
 
@@ -25,32 +27,36 @@ class HTML:
      It is based on Python library 'dominate', a Python library for creating and manipulating HTML documents using a DOM API.
     """
 
-    def __init__(self, web_dir, title, refresh=0):
+    def __init__(self, web_dir, title, refresh=0, file_name="index.html"):
         """Initialize the HTML classes
 
         Parameters:
-            web_dir (str) -- a directory that stores the webpage. HTML file will be created at <web_dir>/index.html; images will be saved at <web_dir/images/
+            web_dir (str) -- a directory that stores the webpage. HTML file will be created at <web_dir>/<file_name>; images will be saved at <web_dir/images/
             title (str)   -- the webpage name
             refresh (int) -- how often the website refresh itself; if 0; no refreshing
+            file_name (str) -- name of the HTML file, e.g. of one page of a paginated table
         """
         self.title = title
         self.web_dir = web_dir
+        self.file_name = file_name
         # self.img_dir = os.path.join(self.web_dir, 'images')
         if not os.path.exists(self.web_dir):
             os.makedirs(self.web_dir)
         # if not os.path.exists(self.img_dir):
         #     os.makedirs(self.img_dir)
 
+        dominate = _dominate()
         self.doc = dominate.document(title=title)
         if refresh > 0:
             with self.doc.head:
-                meta(http_equiv="refresh", content=str(refresh))
+                dominate.tags.meta(http_equiv="refresh", content=str(refresh))
 
     def create_table(self, border, widths):
+        tags = _dominate().tags
         t = tags.table(border=border, style="table-layout: fixed;")  # Insert a table
         self.doc.add(t)
         for width in widths:
-            col(width=f"{width}px")
+            tags.col(width=f"{width}px")
         return t
 
     # def get_image_dir(self):
@@ -64,11 +70,21 @@ class HTML:
             text (str) -- the header text
         """
         with self.doc:
-            h2(text)
+            _dominate().tags.h2(text)
 
     def add_text(self, text):
         with self.doc:
-            tags.p(text)
+            _dominate().tags.p(text)
+
+    def add_links(self, links, sep=" | "):
+        """Insert a line of (text, href) links, e.g. the navigation between pages"""
+        tags = _dominate().tags
+        with self.doc:
+            with tags.p():
+                for i, (text, href) in enumerate(links):
+                    if i > 0:
+                        tags.span(sep)
+                    tags.a(text, href=href)
 
     def add_images(self, t, ims, txts, links, widths, hw_ratio):
         """add images to the HTML file
@@ -77,21 +93,24 @@ class HTML:
             ims (str list)   -- a list of image paths
             txts (str list)  -- a list of image names shown on the website
             links (str list) --  a list of hyperref links; when you click an image, it will redirect you to a new page
+
+        Images are loaded lazily, when they are scrolled into view.
         """
+        tags = _dominate().tags
         with t:
-            with tr():
+            with tags.tr():
                 for im, txt, link, width in zip(ims, txts, links, widths):
-                    with td(style="word-wrap: break-word;", align="center", valign="top"):
+                    with tags.td(style="word-wrap: break-word;", align="center", valign="top"):
                         if txt is not None:
                             tags.p(txt)
                             # br()
                         if im is not None:
-                            with a(href=link):
-                                img(width=width, height=int(width*hw_ratio), src=im)
+                            with tags.a(href=link):
+                                tags.img(width=width, height=int(width*hw_ratio), src=im, loading="lazy")
 
     def set_style(self):
         with self.doc.head:
-            style("""\
+            _dominate().tags.style("""\
              body { 
                  font-family: system-ui, 
                  -apple-system, 
@@ -109,14 +128,28 @@ class HTML:
 
     def save(self):
         """save the current content to the HMTL file"""
-        html_file = '%s/index.html' % self.web_dir
+        html_file = '%s/%s' % (self.web_dir, self.file_name)
         f = open(html_file, 'wt')
         f.write(self.doc.render())
         f.close()
 
 
 class CopyImages(object):
-    def __init__(self, method_list, index_list, dst_dir, rel_dir, skip_exist=False, compress_quality=100):
+    """Copies the input and prediction images of a page into `dst_dir`, transcoding
+    them to JPEG.
+
+    All (method, id, r/s) images go through one thread pool, so a slow method
+    does not hold up the others; cv2 releases the GIL while decoding and
+    encoding. With skip_exist, images already present in the destination are
+    skipped, checked against one listing of each destination directory.
+
+    With thumb_width, a thumbnail of that width is also written to the
+    `thumb_subdir` of every destination directory (see thumbnail_path). A
+    thumbnail carries the mtime of its source and is only rebuilt when the
+    source changes.
+    """
+    def __init__(self, method_list, index_list, dst_dir, rel_dir, skip_exist=False, compress_quality=100,
+                 progress_every=100, thumb_width=None, thumb_subdir="thumbs"):
         self.method_list = method_list
         self.index_list = index_list
         self.dst_dir = dst_dir
@@ -124,58 +157,100 @@ class CopyImages(object):
         self.dst_postfix = "jpg"
         self.compress_quality = compress_quality
         self.skip_exist = skip_exist
-
-    def _copy_single_image(self, src_img_path, subdir, postfix):
-        assert postfix in ["jpg", "jpeg"]
-        file, o_postfix = src_img_path.split('/')[-1].split('.')
-        file_name = f"{file}.{postfix}"
-        out_dir = os.path.join(self.dst_dir, subdir)
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-        out_img_path = os.path.join(out_dir, file_name)
-        if not self.skip_exist or not os.path.exists(out_img_path):
-            if o_postfix == postfix:
+        self.progress_every = progress_every
+        self.thumb_width = thumb_width
+        self.thumb_subdir = thumb_subdir
+
+    def _copy_single_image(self, src_img_path, out_img_path, thumb_path, src_stat):
+        import cv2
+        src_img = None
+        if out_img_path is not None:
+            o_postfix = src_img_path.split('.')[-1]
+            if o_postfix == out_img_path.split('.')[-1]:
                 shutil.copy(src_img_path, out_img_path)
             else:
                 src_img = cv2.imread(src_img_path, cv2.IMREAD_UNCHANGED)
                 cv2.imwrite(out_img_path, src_img, [cv2.IMWRITE_JPEG_QUALITY, self.compress_quality])
-        # img = cv2.imread(out_img_path)
-        # h, w = img.shape[:2]
-        # return os.path.join(os.path.join(subdir, file)), h / w
-
-    def copy_images_from_method(self, m_idx):
-        m = self.method_list[m_idx]
-        for id in self.index_list:
-            r_path, s_path = m.image_loader.get_pred_rs_img_path(id)
-            for p in [r_path, s_path]:
-                self._copy_single_image(p, m.subdir, self.dst_postfix)
-        m.image_loader.set_img_dir(os.path.join(self.rel_dir, m.subdir), self.dst_postfix)
-        return m_idx, m
-        # print("copy", m.image_loader.image_dir, self.method_list[m_idx].image_loader.image_dir)
-
-    def copy_images_from_input_loader(self, loader: InputLoader, subdir):
-        for id in self.index_list:
-            img_path = loader.get_input_img_path(id)
-            self._copy_single_image(img_path, subdir, self.dst_postfix)
+        if thumb_path is not None:
+            if src_img is None:
+                src_img = cv2.imread(src_img_path, cv2.IMREAD_UNCHANGED)
+            h, w = src_img.shape[:2]
+            if w > self.thumb_width:
+                size = (self.thumb_width, max(1, round(h * self.thumb_width / w)))
+                src_img = cv2.resize(src_img, size, interpolation=cv2.INTER_AREA)
+            cv2.imwrite(thumb_path, src_img, [cv2.IMWRITE_JPEG_QUALITY, self.compress_quality])
+            # the mtime of the source marks the thumbnail as up to date
+            os.utime(thumb_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+    def _copy_jobs(self, src_img_paths, subdir, postfix):
+        # (src, dst, thumbnail, src stat) of the images still to be copied into subdir;
+        # dst or thumbnail is None if that one is up to date
+        assert postfix in ["jpg", "jpeg"]
+        out_dir = os.path.join(self.dst_dir, subdir)
+        os.makedirs(out_dir, exist_ok=True)
+        existing = set()
+        if self.skip_exist:
+            with os.scandir(out_dir) as entries:
+                existing = {entry.name for entry in entries}
+        thumb_dir = os.path.join(out_dir, self.thumb_subdir)
+        thumb_mtimes = {}
+        if self.thumb_width is not None:
+            os.makedirs(thumb_dir, exist_ok=True)
+            with os.scandir(thumb_dir) as entries:
+                thumb_mtimes = {entry.name: entry.stat().st_mtime_ns for entry in entries}
+
+        jobs = []
+        for src_img_path in src_img_paths:
+            file_name = f"{src_img_path.split('/')[-1].split('.')[0]}.{postfix}"
+            out_img_path = os.path.join(out_dir, file_name) if file_name not in existing else None
+            thumb_path, src_stat = None, None
+            if self.thumb_width is not None:
+                src_stat = os.stat(src_img_path)
+                if thumb_mtimes.get(file_name) != src_stat.st_mtime_ns:
+                    thumb_path = os.path.join(thumb_dir, file_name)
+            if out_img_path is not None or thumb_path is not None:
+                jobs.append((src_img_path, out_img_path, thumb_path, src_stat))
+        return jobs, len(src_img_paths) - len(jobs)
+
+    def _run_jobs(self, jobs, num_workers):
+        print(f"Copy {len(jobs)} images with {num_workers} threads")
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(self._copy_single_image, *job) for job in jobs]
+            for cnt, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if cnt % self.progress_every == 0 or cnt == len(futures):
+                    print(f"Finish: {cnt}/{len(futures)}")
+
+    def copy_images_from_input_loader(self, loader: InputLoader, subdir, num_workers=1):
+        src_img_paths = [loader.get_input_img_path(id) for id in self.index_list]
+        jobs, num_skipped = self._copy_jobs(src_img_paths, subdir, self.dst_postfix)
+        if num_skipped:
+            print(f"Skip {num_skipped} existing images in {subdir}")
+        self._run_jobs(jobs, num_workers)
         loader.set_img_dir(os.path.join(self.rel_dir, subdir), self.dst_postfix)
         return loader
 
     def run_copy_method_images(self, num_workers):
-        print(f"Multiple threads: {num_workers}")
-        with multiprocessing.Pool(processes=num_workers) as pool:
-            cnt = 0
-            for index, m in pool.imap_unordered(self.copy_images_from_method, range(len(self.method_list))):
-                self.method_list[index] = m
-                cnt += 1
-                print(f"Finish: {cnt}/{len(self.method_list)}")
-        # for m in self.method_list:
-        #     print("run", m.image_loader.image_dir)
+        jobs, num_skipped = [], 0
+        for m in self.method_list:
+            src_img_paths = [p for id in self.index_list for p in m.image_loader.get_pred_rs_img_path(id)]
+            method_jobs, method_skipped = self._copy_jobs(src_img_paths, m.subdir, self.dst_postfix)
+            jobs += method_jobs
+            num_skipped += method_skipped
+        if num_skipped:
+            print(f"Skip {num_skipped} existing images")
+        self._run_jobs(jobs, num_workers)
+        for m in self.method_list:
+            m.image_loader.set_img_dir(os.path.join(self.rel_dir, m.subdir), self.dst_postfix)
         return self.method_list
 
 
-def writing_table(html, input_loader, index_list, method_list):
-    print(f"\nTotal samples: {len(index_list)}")
+def thumbnail_path(img_path, thumb_subdir="thumbs"):
+    """Path of the thumbnail that CopyImages writes for the copied image `img_path`"""
+    return os.path.join(os.path.dirname(img_path), thumb_subdir, os.path.basename(img_path))
 
+
+def _write_rows(html, input_loader, index_list, method_list, image_sizes, thumb_subdir):
     text_width = 50
     img_width = 200
 
@@ -187,6 +262,10 @@ def writing_table(html, input_loader, index_list, method_list):
     # create a table
     tab = html.create_table(0, column_widths)
 
+    def src(path):
+        # show the thumbnail if there is one, the link always opens the full image
+        return thumbnail_path(path, thumb_subdir) if thumb_subdir is not None else path
+
     # add image
     for i in range(len(index_list)):
         # print header
@@ -196,26 +275,69 @@ def writing_table(html, input_loader, index_list, method_list):
         # input image + reflectance
         input_path = input_loader.get_input_img_path(id)
         full_input_path = os.path.join(html.web_dir, input_path)
-        input_img = cv2.imread(full_input_path, cv2.IMREAD_UNCHANGED)
+        if image_sizes is not None:
+            h, w = image_sizes.get(id, full_input_path)
+        else:
+            h, w = read_image_size(full_input_path)
         print(full_input_path)
-        hw_ratio = input_img.shape[0] / input_img.shape[1]
-        ims = [None, input_path]
+        hw_ratio = h / w
+        links = [None, input_path]
         txts = [id, None]
         for m in method_list:
             img_path = m.image_loader.get_pred_rs_img_path(id)[0]
-            ims.append(img_path)
+            links.append(img_path)
             txts.append(None)
-        html.add_images(tab, ims, txts, ims, column_widths, hw_ratio)
+        html.add_images(tab, [src(l) if l is not None else None for l in links], txts, links, column_widths, hw_ratio)
         # shading
-        ims = [None, None]
+        links = [None, None]
         txts = [None, None]
         for m in method_list:
             img_path = m.image_loader.get_pred_rs_img_path(id)[1]
-            ims.append(img_path)
+            links.append(img_path)
             txts.append(None)
-        html.add_images(tab, ims, txts, ims, column_widths, hw_ratio)
+        html.add_images(tab, [src(l) if l is not None else None for l in links], txts, links, column_widths, hw_ratio)
         # print(f"{i}/{len(index_list)}")
+
+
+def writing_table(html, input_loader, index_list, method_list, image_sizes=None, page_size=None,
+                  thumb_subdir=None):
+    """Write the comparison table of `method_list` on `index_list` and save the page.
+
+    The aspect ratio of each row is read from the input image header, through the
+    ImageSizeIndex `image_sizes` if given. With `page_size`, the table is split
+    into pages of that many samples, saved next to `html`, which links to them.
+    With `thumb_subdir`, the thumbnails written by CopyImages are shown and link
+    to the full images.
+    """
+    print(f"\nTotal samples: {len(index_list)}")
+
+    if page_size is None:
+        _write_rows(html, input_loader, index_list, method_list, image_sizes, thumb_subdir)
+    else:
+        pages = [index_list[k:k + page_size] for k in range(0, len(index_list), page_size)]
+        names = [f"page_{k + 1}.html" for k in range(len(pages))]
+        for k, page_ids in enumerate(pages):
+            page = HTML(html.web_dir, f"{html.title} ({k + 1}/{len(pages)})", file_name=names[k])
+            page.set_style()
+            page.add_header(f"{html.title} ({k + 1}/{len(pages)})")
+            nav = [("Index", html.file_name)]
+            if k > 0:
+                nav.append(("Previous", names[k - 1]))
+            if k + 1 < len(pages):
+                nav.append(("Next", names[k + 1]))
+            page.add_links(nav)
+            _write_rows(page, input_loader, page_ids, method_list, image_sizes, thumb_subdir)
+            page.add_links(nav)
+            page.save()
+        tags = _dominate().tags
+        with html.doc:
+            with tags.ul():
+                for k, page_ids in enumerate(pages):
+                    with tags.li():
+                        tags.a(f"Page {k + 1}: samples {page_ids[0]} - {page_ids[-1]}", href=names[k])
     html.save()
+    if image_sizes is not None:
+        image_sizes.save()
     print("Finish writing table.")
 
 
@@ -258,6 +380,7 @@ if __name__ == '__main__':  # we show an example usage here.
     input_loader = InputLoader("./data/iiw-dataset")
 
     # Sampled image index
+    import pickle
     test_list_file_path = "./iiw_test_img_batch.p"
     images_list = pickle.load(open(test_list_file_path, "rb"))
     index_list = []
@@ -283,9 +406,10 @@ if __name__ == '__main__':  # we show an example usage here.
     html_dir = "experiments/NeurIPS2022_supp_web"
     image_rel_dir = "./images"
     html_images_dir = os.path.join(html_dir, image_rel_dir)
-    c = CopyImages(method_list, index_list, html_images_dir, image_rel_dir, skip_exist=True, compress_quality=90)
-    method_list = c.run_copy_method_images(4)
-    input_loader = c.copy_images_from_input_loader(input_loader, "input")
+    c = CopyImages(method_list, index_list, html_images_dir, image_rel_dir, skip_exist=True, compress_quality=90,
+                   thumb_width=200)
+    method_list = c.run_copy_method_images(8)
+    input_loader = c.copy_images_from_input_loader(input_loader, "input", num_workers=8)
 
     # Writing html table
     html = HTML(html_dir, 'CRefNet: Supplemental Results')
@@ -296,5 +420,5 @@ if __name__ == '__main__':  # we show an example usage here.
                   f"file provided by Li and Snavely (2018). For each sample, we show reflectance (top) and shading (below) "
                   f"images.")
     html.add_text("Please note that our estimated reflectance is the most consistent in most cases.")
-    writing_table(html, input_loader, index_list, method_list)
+    writing_table(html, input_loader, index_list, method_list, page_size=50, thumb_subdir=c.thumb_subdir)
 
@@ -1,39 +1,226 @@
 import os
 import json
-import urllib.request
-import multiprocessing
-from PIL import Image
+import argparse
+import hashlib
+import http.client
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class Manifest(object):
+    """Size, checksum and mtime of every completed download, persisted as json.
+
+    A target whose file still has the recorded size and mtime is complete, so
+    skipping it takes a single stat(). A file of the recorded size but another
+    mtime, e.g. a copy, is complete if its checksum matches.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_complete(self, filename):
+        entry = self.entries.get(filename)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return False
+        if st.st_size != entry["size"]:
+            return False
+        if st.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        if _sha256_of_file(filename).hexdigest() != entry["sha256"]:
+            return False
+        with self.lock:
+            entry["mtime_ns"] = st.st_mtime_ns
+        return True
+
+    def record(self, filename, sha256):
+        st = os.stat(filename)
+        with self.lock:
+            self.entries[filename] = {"size": st.st_size, "sha256": sha256, "mtime_ns": st.st_mtime_ns}
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+
+
+def _sha256_of_file(filename, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h
 
 
-# async worker
 class Download(object):
-    def __init__(self, jobs):
+    """Downloads (url, filename) jobs on a thread pool.
+
+    Each file is written to <filename>.part and renamed when complete, so an
+    interrupted run leaves no truncated images; the next run resumes the .part
+    file with an HTTP Range request. Every thread keeps one connection per host
+    open across its downloads. Completed files are recorded in the Manifest.
+    Files that predate the manifest are adopted if PIL can open them.
+    """
+    max_redirects = 5
+
+    def __init__(self, jobs, manifest_path="download_manifest.json", timeout=60, retries=3,
+                 chunk_size=1 << 16, save_every=100):
         self.jobs = jobs
+        self.manifest = Manifest(manifest_path)
+        self.timeout = timeout
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.save_every = save_every
+        self.local = threading.local()
 
-    def download(self, idx):
-        job = self.jobs[idx]
-        url, filename = job
-        exists = False
+    def _connection(self, scheme, netloc):
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            conn = connections[(scheme, netloc)] = conn_class(netloc, timeout=self.timeout)
+        return conn
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self.local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def _open(self, url, headers):
+        # GET on the pooled connection of the host, following redirects
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # the server closed the kept-alive connection; retry once on a new one
+                self._drop_connection(parts.scheme, parts.netloc)
+                conn = self._connection(parts.scheme, parts.netloc)
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                location = response.getheader("Location")
+                if location is None:
+                    raise IOError(f"HTTP {response.status} without a Location for {url}")
+                url = urllib.parse.urljoin(url, location)
+                continue
+            return response
+        raise IOError(f"Too many redirects: {url}")
+
+    def _adopt_existing(self, filename):
+        # a file downloaded before the manifest existed
+        from PIL import Image
+        try:
+            with Image.open(filename) as image:
+                if not all(image.size):
+                    return False
+        except Exception:
+            return False
+        self.manifest.record(filename, _sha256_of_file(filename).hexdigest())
+        return True
+
+    def _fetch(self, url, filename):
+        part_path = filename + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        sha256 = _sha256_of_file(part_path) if offset else hashlib.sha256()
+        response = self._open(url, {"Range": f"bytes={offset}-"} if offset else {})
         try:
-            image = Image.open(filename)
-            if all(image.size):
-                exists = True
-        except:
-            exists = False
-        if not exists:
-            urllib.request.urlretrieve(url, filename)
-        print(f"\t download: {filename}")
+            if response.status == 416 and offset:
+                # the .part file already holds everything
+                total = response.getheader("Content-Range", "").rpartition("/")[2]
+                response.read()
+                if total != str(offset):
+                    os.remove(part_path)
+                    raise IOError(f"Stale partial file: {part_path}")
+            elif response.status in (200, 206):
+                if response.status == 200:
+                    offset, sha256 = 0, hashlib.sha256()
+                elif not response.getheader("Content-Range", "").startswith(f"bytes {offset}-"):
+                    raise IOError(f"Unexpected Content-Range for {url}")
+                length = response.getheader("Content-Length")
+                received = 0
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in iter(lambda: response.read(self.chunk_size), b""):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        received += len(chunk)
+                if length is not None and received != int(length):
+                    raise IOError(f"Incomplete download of {url}: {received}/{length} bytes")
+            else:
+                response.read()
+                raise IOError(f"HTTP {response.status} for {url}")
+        finally:
+            response.close()
+        os.replace(part_path, filename)
+        self.manifest.record(filename, sha256.hexdigest())
+
+    def download(self, idx):
+        """Returns whether the file had to be downloaded"""
+        url, filename = self.jobs[idx]
+        if self.manifest.is_complete(filename):
+            return False
+        if os.path.exists(filename) and self._adopt_existing(filename):
+            return False
+        for attempt in range(self.retries):
+            try:
+                self._fetch(url, filename)
+                return True
+            except (IOError, http.client.HTTPException) as e:
+                if attempt + 1 == self.retries:
+                    raise
+                print(f"\t retry {filename}: {e}")
 
     def run(self, num_workers):
         print(f"Multiple threads: {num_workers}")
-        with multiprocessing.Pool(processes=num_workers) as pool:
-                cnt = 0
-                for index in pool.imap_unordered(self.download, range(len(self.jobs))):
-                    cnt += 1
-                    print(f"Finish: {cnt}/{len(self.jobs)}")
+        num_downloaded, failed = 0, []
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = {executor.submit(self.download, idx): idx for idx in range(len(self.jobs))}
+                for cnt, future in enumerate(as_completed(futures), 1):
+                    try:
+                        if future.result():
+                            num_downloaded += 1
+                            print(f"\t download: {self.jobs[futures[future]][1]}")
+                    except Exception as e:
+                        failed.append(self.jobs[futures[future]])
+                        print(f"\t failed: {self.jobs[futures[future]][1]}: {e}")
+                    if cnt % self.save_every == 0:
+                        self.manifest.save()
+                        print(f"Finish: {cnt}/{len(self.jobs)}")
+        finally:
+            self.manifest.save()
+        print(f"Downloaded {num_downloaded}, skipped {len(self.jobs) - num_downloaded - len(failed)}, "
+              f"failed {len(failed)}")
+        return failed
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export", default="./intrinsic-decompositions-export.json", metavar="FILE",
+                        help="Path to the decompositions export json", type=str)
+    parser.add_argument("--manifest", default="./download_manifest.json", metavar="FILE",
+                        help="Path to the manifest of completed downloads", type=str)
+    parser.add_argument("--workers", default=4, metavar="N", help="Number of download threads", type=int)
+    args = parser.parse_args()
+
     # Algorithm decompositions to download (indexed by slug).  In our publication
     # [Bell et al 2014], we evaluated these algorithms:
     ALGORITHMS_TO_DOWNLOAD = set((
@@ -53,7 +240,7 @@ if __name__ == '__main__':
     DOWNLOAD_ORIGINAL_IMAGES = False
 
     # Prepare list of files to download, by parsing the included JSON file
-    algorithms = json.load(open('./intrinsic-decompositions-export.json'))
+    algorithms = json.load(open(args.export))
     jobs = []
     for algorithm in algorithms:
         if algorithm['slug'] in ALGORITHMS_TO_DOWNLOAD:
@@ -75,7 +262,7 @@ if __name__ == '__main__':
 
 
     # remove dupliates (this will happen based on the way the loop is set up)
-    jobs = list(set(jobs))
+    jobs = sorted(set(jobs), key=lambda job: job[1])
 
     # create directories
     if DOWNLOAD_ORIGINAL_IMAGES and not os.path.isdir('original_image'):
@@ -84,18 +271,8 @@ if __name__ == '__main__':
         if not os.path.isdir(slug):
             os.makedirs(slug)
 
-
-    # set up pool
-    cpu_count = 4  #multiprocessing.cpu_count()
-    print('\nDownloading %s images using %s worker processes...' % (len(jobs), cpu_count))
-    print("No progress bar, sorry.  Note that existing images are skipped.")
-
-    # Use map_async with a long timeout instead of map -- this avoids a
-    # KeyboardInterrupt-related bug in Python.
-    # for j in jobs:
-    #     download(j)
-    # pool = multiprocessing.Pool(cpu_count)
-    # pool.map_async(download, jobs).get(999999)
-    d = Download(jobs)
-    d.run(cpu_count)
-    print('Done!')
+    print('\nDownloading %s images using %s threads...' % (len(jobs), args.workers))
+    print("Completed images are recorded in %s and skipped; interrupted ones are resumed." % args.manifest)
+    d = Download(jobs, args.manifest)
+    failed = d.run(args.workers)
+    print('Done!' if not failed else 'Done, %s images failed; run again to retry them.' % len(failed))
@@ -0,0 +1,79 @@
+import json
+import os
+
+import numpy as np
+
+import metrics_iiw
+from prediction_loader import General_Loader
+
+
+def read_export(export_path):
+    """Algorithms of intrinsic-decompositions-export.json (see iiw-decompositions/README.md)"""
+    with open(export_path) as f:
+        return json.load(f)
+
+
+def discover_slugs(algorithms, root):
+    """Slugs of the algorithms with a download directory in `root`"""
+    return [algorithm['slug'] for algorithm in algorithms if os.path.isdir(os.path.join(root, algorithm['slug']))]
+
+
+class ExportLoader(General_Loader):
+    """General_Loader of an algorithm downloaded by iiw-decompositions/download_images.py.
+
+    The decompositions are scored at their own resolution, like the whdr.py of
+    IIW that computed the export mean_error. Images whose download is missing,
+    e.g. after an interrupted run, are skipped.
+    """
+    skip_missing = True
+    native_resolution = True
+
+
+def export_loaders(algorithms, root):
+    """{slug: ExportLoader} of every downloaded algorithm"""
+    return {slug: ExportLoader(os.path.join(root, slug)) for slug in discover_slugs(algorithms, root)}
+
+
+class ExportErrorCheck(object):
+    """Compares per-image WHDR with the mean_error of the export.
+
+    Pass `add` as the on_result callback of compute_iiw_whdr.evaluate_ids. The
+    export errors were computed at threshold 0.1 on linear reflectance at the
+    resolution of the decomposition, so the run should include t=0.1, use space
+    "rgb" and score the ExportLoaders of export_loaders for the comparison to be
+    exact.
+    """
+
+    def __init__(self, algorithms, deltas, delta=0.1):
+        self.index = deltas.index(delta) if delta in deltas else None
+        self.expected = {algorithm['slug']: {str(d['photo_id']): d['mean_error']
+                                             for d in algorithm['intrinsic_images_decompositions']}
+                         for algorithm in algorithms}
+        self.diffs = {}
+
+    def add(self, result):
+        if self.index is None:
+            return
+        for name, sums in result.sums.items():
+            expected = self.expected.get(name, {}).get(result.id)
+            whdr = metrics_iiw.whdr_from_sums(sums[self.index])
+            if expected is None or whdr is None:
+                continue
+            self.diffs.setdefault(name, []).append((result.id, whdr[0][0] - expected))
+
+    def report(self, tolerance=1e-4):
+        """Print the deviation of every checked algorithm; returns whether all are within `tolerance`"""
+        if self.index is None:
+            print("\nExport check skipped: the run has no threshold 0.1")
+            return False
+        ok = True
+        print(f"\nPer-image WHDR against the export mean_error (tolerance {tolerance})")
+        print(f"{'slug':<32} {'images':>8} {'max |diff|':>12} {'mean |diff|':>12} {'above':>8}")
+        for name, diffs in self.diffs.items():
+            d = np.abs(np.array([diff for _, diff in diffs]))
+            above = [id for id, diff in diffs if abs(diff) > tolerance]
+            ok = ok and not above
+            print(f"{name:<32} {len(d):>8} {d.max():>12.6f} {d.mean():>12.6f} {len(above):>8}")
+            if above:
+                print(f"\te.g. {', '.join(above[:10])}")
+        return ok
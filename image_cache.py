@@ -0,0 +1,153 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+import util
+
+
+def read_image(path):
+    """Decode an image file to an RGB array of its stored integer type (uint8 or uint16)"""
+    import cv2
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError(f"Cannot read image: {path}")
+    if image.ndim == 3:
+        # BGR(A) -> RGB
+        image = np.ascontiguousarray(image[:, :, 2::-1])
+    return image
+
+
+class DecodedImageCache(object):
+    """In-process LRU cache of decoded images, keyed by path.
+
+    An entry is only served while the file keeps the mtime and size it was
+    decoded from. The cached arrays are read-only; at most `max_bytes` bytes
+    of them are kept, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        # path -> ((mtime, size), image)
+        self.entries = util.ByteLRUCache(_entry_nbytes, max_bytes)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        image = read_image(path)
+        image.flags.writeable = False
+        self.entries.put(path, (key, image))
+        return image
+
+
+def _entry_nbytes(entry):
+    return entry[1].nbytes
+
+
+class DiskImageCache(object):
+    """Persistent cache of decoded images as .npy files in `cache_dir`, read back
+    memory-mapped.
+
+    Entries are keyed by the absolute path, mtime and size of the image, so a
+    changed image is decoded again. Arrays keep the stored integer type (uint8
+    for 8 bit images). The mtime of an entry records its last use; once the
+    entries exceed `max_bytes`, the least recently used ones are deleted. The
+    directory can be shared by concurrent processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=8 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.nbytes = None  # total size of the entries, counted on the first insert
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["nbytes"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _entry_path(self, path, st):
+        key = f"{os.path.abspath(path)}\0{st.st_mtime_ns}\0{st.st_size}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def _entries(self):
+        # (last use, size, path) of every entry
+        with os.scandir(self.cache_dir) as it:
+            return [(e.stat().st_mtime_ns, e.stat().st_size, e.path) for e in it
+                    if e.name.endswith(".npy") and not e.name.endswith(".tmp.npy")]
+
+    def __len__(self):
+        return len(self._entries())
+
+    def clear(self):
+        with self.lock:
+            for _, _, entry in self._entries():
+                os.remove(entry)
+            self.nbytes = 0
+
+    def get(self, path):
+        entry = self._entry_path(path, os.stat(path))
+        try:
+            image = np.load(entry, mmap_mode='r')
+            os.utime(entry)
+            return image
+        except (FileNotFoundError, ValueError):
+            pass
+
+        image = read_image(path)
+        tmp_path = f"{entry[:-len('.npy')]}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        np.save(tmp_path, image)
+        os.replace(tmp_path, entry)
+        self._added(os.path.getsize(entry))
+        return np.load(entry, mmap_mode='r')
+
+    def _added(self, size):
+        with self.lock:
+            if self.nbytes is None:
+                self.nbytes = sum(s for _, s, _ in self._entries())
+            else:
+                self.nbytes += size
+            if self.nbytes <= self.max_bytes:
+                return
+            # other processes may have added entries too, so evict from a fresh listing
+            entries = sorted(self._entries())
+            self.nbytes = sum(s for _, s, _ in entries)
+            for _, size, entry in entries[:-1]:
+                if self.nbytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
+                self.nbytes -= size
+
+
+# used by the image-backed prediction loaders unless they are given a cache
+_default_cache = DecodedImageCache()
+
+
+def get_default_cache():
+    return _default_cache
+
+
+def set_default_cache(cache):
+    """Use `cache`, e.g. a DiskImageCache, for every loader without a cache of its own.
+    The worker processes of whdr_pipeline.evaluate_stream are given it as well."""
+    global _default_cache
+    _default_cache = cache
@@ -0,0 +1,95 @@
+import json
+import os
+import struct
+
+
+# JPEG start-of-frame markers carrying the image size (all SOFn but DHT, JPG and DAC)
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _read_png_size(f):
+    # 8 byte signature, then the IHDR chunk: length, type, width, height
+    header = f.read(24)
+    if len(header) < 24 or header[12:16] != b'IHDR':
+        raise ValueError("Invalid PNG header")
+    w, h = struct.unpack(">II", header[16:24])
+    return h, w
+
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise ValueError("Truncated image header")
+    return data
+
+
+def _read_jpeg_size(f):
+    f.read(2)  # SOI
+    while True:
+        byte = f.read(1)
+        if not byte:
+            raise ValueError("No JPEG frame header")
+        if byte != b'\xff':
+            continue
+        marker = _read_exact(f, 1)
+        while marker == b'\xff':  # fill bytes
+            marker = _read_exact(f, 1)
+        marker = ord(marker)
+        if marker == 0xD8 or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            continue  # markers without payload
+        length, = struct.unpack(">H", _read_exact(f, 2))
+        if marker in _JPEG_SOF_MARKERS:
+            _precision, h, w = struct.unpack(">BHH", _read_exact(f, 5))
+            return h, w
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_size(path):
+    """(height, width) of a PNG or JPEG image, read from its header without decoding it"""
+    with open(path, 'rb') as f:
+        signature = f.read(8)
+        f.seek(0)
+        if signature == b'\x89PNG\r\n\x1a\n':
+            return _read_png_size(f)
+        if signature[:2] == b'\xff\xd8':
+            return _read_jpeg_size(f)
+    raise ValueError(f"Unsupported image format: {path}")
+
+
+class ImageSizeIndex(object):
+    """Persisted {key: (height, width)} index of image sizes.
+
+    Missing entries are read from the image header with read_image_size and
+    written back to `index_path` by save(). Pass index_path=None to keep the
+    index in memory only, as it is if `index_path` cannot be written.
+    """
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self.sizes = {}
+        self.modified = False
+        if index_path is not None and os.path.exists(index_path):
+            with open(index_path) as f:
+                self.sizes = {k: tuple(v) for k, v in json.load(f).items()}
+
+    def get(self, key, image_path):
+        size = self.sizes.get(key)
+        if size is None:
+            size = read_image_size(image_path)
+            self.sizes[key] = size
+            self.modified = True
+        return size
+
+    def save(self):
+        if self.index_path is None or not self.modified:
+            return
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.sizes, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # e.g. a read-only dataset checkout; keep the index in memory from now on
+            print(f"Cannot write the image size index {self.index_path}, keeping it in memory: {e}")
+            self.index_path = None
+        self.modified = False
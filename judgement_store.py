@@ -0,0 +1,145 @@
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from metrics_iiw import JudgementArrays, compile_judgements
+
+
+class JudgementStore(object):
+    """IIW judgements of a whole directory compiled into a single .npz file.
+
+    The point and comparison arrays of all images are concatenated and indexed
+    by per-image offsets, so looking up an image is a couple of array slices
+    instead of a json parse. The cache records the size and mtime of every
+    source json file and is recompiled whenever they no longer match. If the
+    cache cannot be written, the compiled judgements are only kept in memory.
+    """
+    version = 1
+
+    def __init__(self, judgement_dir, cache_path=None, verbose=True):
+        self.judgement_dir = judgement_dir
+        self.cache_path = cache_path if cache_path is not None \
+            else os.path.join(judgement_dir, "judgements_cache.npz")
+        self.verbose = verbose
+
+        fingerprint = self._fingerprint()
+        arrays = self._load(fingerprint)
+        if arrays is None:
+            arrays = self._compile(fingerprint)
+        self.arrays = arrays
+        self.id_to_index = {id: i for i, id in enumerate(arrays["ids"].tolist())}
+
+    def _fingerprint(self):
+        paths = sorted(glob.glob(os.path.join(self.judgement_dir, "*.json")))
+        ids, mtimes, sizes = [], [], []
+        for p in paths:
+            st = os.stat(p)
+            ids.append(os.path.basename(p)[:-len(".json")])
+            mtimes.append(st.st_mtime_ns)
+            sizes.append(st.st_size)
+        return np.array(ids, dtype=str), np.array(mtimes, dtype=np.int64), np.array(sizes, dtype=np.int64)
+
+    def _load(self, fingerprint):
+        if not os.path.exists(self.cache_path):
+            return None
+        with np.load(self.cache_path) as f:
+            arrays = dict(f)
+        ids, mtimes, sizes = fingerprint
+        if int(arrays["version"]) != self.version \
+                or not np.array_equal(arrays["ids"], ids) \
+                or not np.array_equal(arrays["mtime_ns"], mtimes) \
+                or not np.array_equal(arrays["size"], sizes):
+            if self.verbose:
+                print(f"Judgement cache is out of date: {self.cache_path}")
+            return None
+        return arrays
+
+    def _compile(self, fingerprint):
+        ids, mtimes, sizes = fingerprint
+        if self.verbose:
+            print(f"Compiling {len(ids)} judgement files into {self.cache_path}")
+        compiled = []
+        for id in ids:
+            with open(os.path.join(self.judgement_dir, f"{id}.json")) as f:
+                compiled.append(compile_judgements(json.load(f)))
+
+        def offsets(lengths):
+            return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+        def concat(field, dtype):
+            if not compiled:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate([getattr(c, field) for c in compiled]).astype(dtype)
+
+        arrays = {
+            "version": np.array(self.version),
+            "ids": ids,
+            "mtime_ns": mtimes,
+            "size": sizes,
+            "point_offsets": offsets([len(c.point_x) for c in compiled]),
+            "comparison_offsets": offsets([len(c.weight) for c in compiled]),
+            "point_x": concat("point_x", np.float64),
+            "point_y": concat("point_y", np.float64),
+            # point indices are local to the image
+            "point1": concat("point1", np.int32),
+            "point2": concat("point2", np.int32),
+            "weight": concat("weight", np.float64),
+            "darker": concat("darker", np.int8),
+        }
+
+        tmp_path = self.cache_path + ".tmp.npz"
+        try:
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            # e.g. a read-only dataset checkout; the compiled judgements are then only kept in memory
+            print(f"Cannot write the judgement cache {self.cache_path}, keeping it in memory: {e}")
+        return arrays
+
+    def __len__(self):
+        return len(self.id_to_index)
+
+    def __contains__(self, id):
+        return str(id) in self.id_to_index
+
+    def get(self, id):
+        i = self.id_to_index[str(id)]
+        a = self.arrays
+        ps, pe = a["point_offsets"][i], a["point_offsets"][i + 1]
+        cs, ce = a["comparison_offsets"][i], a["comparison_offsets"][i + 1]
+        return JudgementArrays(point_x=a["point_x"][ps:pe], point_y=a["point_y"][ps:pe],
+                               point1=a["point1"][cs:ce], point2=a["point2"][cs:ce],
+                               weight=a["weight"][cs:ce], darker=a["darker"][cs:ce])
+
+    def get_key(self, id):
+        """mtime and size of the json file the judgements of `id` were compiled from"""
+        i = self.id_to_index[str(id)]
+        return f"{self.arrays['mtime_ns'][i]}-{self.arrays['size'][i]}"
+
+    def get_by_path(self, judgement_path):
+        """Look up the judgements of `{id}.json` stored in this store's directory."""
+        return self.get(os.path.basename(judgement_path)[:-len(".json")])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--iiwdir",
+        default="./data/iiw-dataset",
+        metavar="FILE",
+        help="Path to the IIW dataset",
+        type=str,
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        metavar="FILE",
+        help="Path to the compiled judgement file (default: <iiwdir>/data/judgements_cache.npz)",
+        type=str,
+    )
+    args = parser.parse_args()
+    store = JudgementStore(os.path.join(args.iiwdir, "data"), args.cache)
+    print(f"{len(store)} judgement files in {store.cache_path}")
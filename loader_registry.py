@@ -0,0 +1,73 @@
+import importlib
+import json
+import os
+
+# {name: spec} of the methods evaluated by compute_iiw_whdr. A spec names the loader
+# "class", either in prediction_loader or as "module:Class", its result "path" and
+# optional keyword "options" of the constructor
+DEFAULT_LOADERS = {
+    "Li_2018_full": {"class": "Li_2018_CGI_Loader", "path": "./Li_2018_CGIntrinsics/CGI+IIW+SAW/cgi_iiw"},
+    "Li_2018_cgi": {"class": "Li_2018_CGI_Loader", "path": "./Li_2018_CGIntrinsics/CGI/cgi_iiw"},
+    "Luo_2020": {"class": "Luo_2020_NIID_Net_Loader", "path": "./Luo_2020_NIID-Net", "options": {"mmap_mode": "r"}},
+}
+
+
+def loader_class(name):
+    """The loader class named by a spec"""
+    module_name, _, class_name = name.rpartition(":")
+    module = importlib.import_module(module_name or "prediction_loader")
+    try:
+        return getattr(module, class_name)
+    except AttributeError:
+        raise ValueError(f"Unknown loader class: {name}") from None
+
+
+class LoaderRegistry(object):
+    """{name: PredictionLoader} built from declarative specs (see DEFAULT_LOADERS).
+
+    A loader is only constructed, and the modules it needs only imported, when
+    it is first looked up.
+    """
+
+    def __init__(self, specs=None):
+        self.specs = dict(DEFAULT_LOADERS if specs is None else specs)
+        self.loaders = {}
+
+    @classmethod
+    def from_file(cls, path):
+        """Registry of the {name: spec} json `path`; relative result paths are
+        resolved against the directory of the file"""
+        with open(path) as f:
+            specs = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(path))
+        for name, spec in specs.items():
+            if "class" not in spec or "path" not in spec:
+                raise ValueError(f"Loader {name} in {path} needs a class and a path")
+            spec["path"] = os.path.join(base_dir, os.path.expanduser(spec["path"]))
+        return cls(specs)
+
+    def register(self, name, loader):
+        """Add a spec dict, or an already constructed loader"""
+        if isinstance(loader, dict):
+            self.specs[name] = loader
+            self.loaders.pop(name, None)
+        else:
+            self.specs[name] = None
+            self.loaders[name] = loader
+
+    def __getitem__(self, name):
+        loader = self.loaders.get(name)
+        if loader is None:
+            spec = self.specs[name]
+            loader = loader_class(spec["class"])(spec["path"], **spec.get("options", {}))
+            self.loaders[name] = loader
+        return loader
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def __len__(self):
+        return len(self.specs)
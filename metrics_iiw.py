@@ -1,80 +1,238 @@
 # Codes are adapted from: https://github.com/zhengqili/CGIntrinsics
 
 import json
+from collections import namedtuple
 
 import numpy as np
-from skimage.transform import resize
 
+import util
 
-def compute_whdr(reflectance, judgements, delta=0.1):
-    points = judgements['intrinsic_points']
-    comparisons = judgements['intrinsic_comparisons']
-    id_to_points = {p['id']: p for p in points}
-    rows, cols = reflectance.shape[0:2]
 
-    error_sum = 0.0
-    error_equal_sum = 0.0
-    error_inequal_sum = 0.0
+# Comparisons in array form: point coordinates, endpoint indices into them,
+# weights ("w_i") and human labels ("J_i", see DARKER_CODES).
+JudgementArrays = namedtuple("JudgementArrays", ["point_x", "point_y", "point1", "point2", "weight", "darker"])
 
-    weight_sum = 0.0
-    weight_equal_sum = 0.0
-    weight_inequal_sum = 0.0
+DARKER_CODES = {'E': 0, '1': 1, '2': 2}
 
-    for c in comparisons:
-        # "darker" is "J_i" in our paper
-        darker = c['darker']
-        if darker not in ('1', '2', 'E'):
-            continue
+# Weighted error and weight totals of one image, overall and for the equal/inequal comparisons
+WHDRSums = namedtuple("WHDRSums", ["error", "error_equal", "error_inequal", "weight", "weight_equal", "weight_inequal"])
 
-        # "darker_score" is "w_i" in our paper
-        weight = c['darker_score']
-        if weight <= 0.0 or weight is None:
-            continue
 
-        point1 = id_to_points[c['point1']]
-        point2 = id_to_points[c['point2']]
-        if not point1['opaque'] or not point2['opaque']:
+def compile_judgements(judgements):
+    """Convert IIW json judgements to JudgementArrays.
+
+    Comparisons that compute_whdr ignores (unknown label, non-positive weight or
+    non-opaque endpoints) are dropped here, so they never reach the scoring.
+    """
+    points = judgements['intrinsic_points']
+    id_to_index = {p['id']: i for i, p in enumerate(points)}
+    point_x = np.array([p['x'] for p in points], dtype=np.float64)
+    point_y = np.array([p['y'] for p in points], dtype=np.float64)
+    opaque = [bool(p['opaque']) for p in points]
+
+    point1, point2, weight, darker = [], [], [], []
+    for c in judgements['intrinsic_comparisons']:
+        if c['darker'] not in DARKER_CODES:
+            continue
+        if c['darker_score'] is None or c['darker_score'] <= 0.0:
             continue
+        i1 = id_to_index[c['point1']]
+        i2 = id_to_index[c['point2']]
+        if not opaque[i1] or not opaque[i2]:
+            continue
+        point1.append(i1)
+        point2.append(i2)
+        weight.append(c['darker_score'])
+        darker.append(DARKER_CODES[c['darker']])
 
-        # convert to grayscale and threshold
-        l1 = max(1e-10, np.mean(reflectance[
-                                    int(point1['y'] * rows), int(point1['x'] * cols), ...]))
-        l2 = max(1e-10, np.mean(reflectance[
-                                    int(point2['y'] * rows), int(point2['x'] * cols), ...]))
-
-        # # convert algorithm value to the same units as human judgements
-        if l2 / l1 > 1.0 + delta:
-            alg_darker = '1'
-        elif l1 / l2 > 1.0 + delta:
-            alg_darker = '2'
-        else:
-            alg_darker = 'E'
+    return JudgementArrays(point_x=point_x, point_y=point_y,
+                           point1=np.array(point1, dtype=np.int64),
+                           point2=np.array(point2, dtype=np.int64),
+                           weight=np.array(weight, dtype=np.float64),
+                           darker=np.array(darker, dtype=np.int8))
 
-        if darker == 'E':
-            if darker != alg_darker:
-                error_equal_sum += weight
 
-            weight_equal_sum += weight
-        else:
-            if darker != alg_darker:
-                error_inequal_sum += weight
+class JudgementCache(object):
+    """In-process LRU cache of compiled judgements, keyed by json path.
+
+    Meant for long running jobs that score the same images repeatedly, e.g.
+    validation during training: each judgement file is parsed once and then
+    served from memory. The cache holds at most `max_items` entries (no limit
+    if None) and at most `max_bytes` bytes of arrays; the least recently used
+    entries are evicted first. get_by_path matches JudgementStore, so both can
+    be passed as `judgement_store` to evaluate_WHDR.
+    """
+
+    def __init__(self, max_items=None, max_bytes=256 * 2 ** 20):
+        self.entries = util.ByteLRUCache(_judgements_nbytes, max_bytes, max_items)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_by_path(self, judgement_path):
+        judgements = self.entries.get(judgement_path)
+        if judgements is not None:
+            return judgements
+
+        with open(judgement_path) as f:
+            judgements = compile_judgements(json.load(f))
+        self.entries.put(judgement_path, judgements)
+        return judgements
+
+    def set_limits(self, max_items=None, max_bytes=256 * 2 ** 20):
+        self.entries.set_limits(max_bytes, max_items)
+
+
+def _judgements_nbytes(judgements):
+    return sum(a.nbytes for a in judgements)
+
 
-            weight_inequal_sum += weight
+# used by evaluate_WHDR when no judgement store is given
+judgement_cache = JudgementCache()
 
-        if darker != alg_darker:
-            error_sum += weight
 
-        weight_sum += weight
+def _sequential_sum(values):
+    # same rounding as accumulating the values one by one in a python loop
+    if values.size == 0:
+        return 0.0
+    return float(np.cumsum(values)[-1])
 
-    if weight_sum:
-        return (error_sum / weight_sum, weight_sum > 1e-5), \
-               (error_equal_sum / max(weight_equal_sum, 1e-6), weight_equal_sum > 1e-5), \
-               (error_inequal_sum / max(weight_inequal_sum, 1e-6), weight_inequal_sum > 1e-5)
+
+def judgement_pixels(comparisons, rows, cols):
+    ys = (comparisons.point_y * rows).astype(np.int64)
+    xs = (comparisons.point_x * cols).astype(np.int64)
+    return ys, xs
+
+
+def _to_luminance(values):
+    # convert to grayscale
+    if values.ndim > 1:
+        values = values.mean(axis=tuple(range(1, values.ndim)))
+    return values
+
+
+def gather_luminance(reflectance, comparisons):
+    rows, cols = reflectance.shape[0:2]
+    ys, xs = judgement_pixels(comparisons, rows, cols)
+    lum = _to_luminance(reflectance[ys, xs, ...])
+    return lum[comparisons.point1], lum[comparisons.point2]
+
+
+def sample_luminance(prediction, original_shape, comparisons, anti_aliasing=False, transform=None):
+    """Like gather_luminance(resize(prediction, original_shape, order=1, ...), ...),
+    but interpolating only the judgement points (see util.sample_resize)."""
+    rows, cols = original_shape[0:2]
+    ys, xs = judgement_pixels(comparisons, rows, cols)
+    lum = _to_luminance(util.sample_resize(prediction, (rows, cols), ys, xs, anti_aliasing, transform))
+    return lum[comparisons.point1], lum[comparisons.point2]
+
+
+def luminance_ratios(l1, l2):
+    l1 = np.maximum(l1, 1e-10)
+    l2 = np.maximum(l2, 1e-10)
+    return l2 / l1, l1 / l2
+
+
+def comparison_errors(ratio21, ratio12, comparisons, delta=0.1):
+    """Boolean array flagging the comparisons the prediction disagrees with"""
+    # convert algorithm value to the same units as human judgements
+    alg_darker = np.where(ratio21 > 1.0 + delta, DARKER_CODES['1'],
+                          np.where(ratio12 > 1.0 + delta, DARKER_CODES['2'], DARKER_CODES['E']))
+    return comparisons.darker != alg_darker
+
+
+def whdr_sums_from_ratios(ratio21, ratio12, comparisons, delta=0.1):
+    weight = comparisons.weight
+    error = comparison_errors(ratio21, ratio12, comparisons, delta)
+    equal = comparisons.darker == DARKER_CODES['E']
+
+    return WHDRSums(error=_sequential_sum(weight[error]),
+                    error_equal=_sequential_sum(weight[error & equal]),
+                    error_inequal=_sequential_sum(weight[error & ~equal]),
+                    weight=_sequential_sum(weight),
+                    weight_equal=_sequential_sum(weight[equal]),
+                    weight_inequal=_sequential_sum(weight[~equal]))
+
+
+def whdr_from_sums(sums):
+    if sums.weight:
+        return (sums.error / sums.weight, sums.weight > 1e-5), \
+               (sums.error_equal / max(sums.weight_equal, 1e-6), sums.weight_equal > 1e-5), \
+               (sums.error_inequal / max(sums.weight_inequal, 1e-6), sums.weight_inequal > 1e-5)
     else:
         return None
 
 
-def evaluate_WHDR(prediction_R, targets):
+def whdr_from_ratios(ratio21, ratio12, comparisons, delta=0.1):
+    return whdr_from_sums(whdr_sums_from_ratios(ratio21, ratio12, comparisons, delta))
+
+
+def whdr_from_luminance(l1, l2, comparisons, delta=0.1):
+    ratio21, ratio12 = luminance_ratios(l1, l2)
+    return whdr_from_ratios(ratio21, ratio12, comparisons, delta)
+
+
+def compute_whdr(reflectance, judgements, delta=0.1):
+    """WHDR of a reflectance map at the resolution of the IIW input image.
+
+    `judgements` is either the parsed json of an IIW image or the
+    JudgementArrays built from it by compile_judgements.
+    """
+    if not isinstance(judgements, JudgementArrays):
+        judgements = compile_judgements(judgements)
+    l1, l2 = gather_luminance(reflectance, judgements)
+    return whdr_from_luminance(l1, l2, judgements, delta)
+
+
+def compute_whdr_sparse(prediction, original_shape, judgements, delta=0.1, anti_aliasing=False,
+                        transform=None):
+    """compute_whdr of `prediction` resized to `original_shape`, without resizing it.
+
+    Matches compute_whdr(resize(prediction, original_shape, order=1, preserve_range=True,
+    anti_aliasing=anti_aliasing), judgements, delta) up to floating point rounding.
+    `transform` is applied to the prediction pixels that are read, see util.sample_resize.
+    """
+    if not isinstance(judgements, JudgementArrays):
+        judgements = compile_judgements(judgements)
+    l1, l2 = sample_luminance(prediction, original_shape, judgements, anti_aliasing, transform)
+    return whdr_from_luminance(l1, l2, judgements, delta)
+
+
+def judgement_ratios(reflectance, judgements, original_shape=None, anti_aliasing=False, transform=None):
+    """Compiled judgements and the luminance ratios (l2/l1, l1/l2) of their endpoints,
+    read from `reflectance` as in compute_whdr_sweep"""
+    if not isinstance(judgements, JudgementArrays):
+        judgements = compile_judgements(judgements)
+    if original_shape is not None:
+        l1, l2 = sample_luminance(reflectance, original_shape, judgements, anti_aliasing, transform)
+    else:
+        l1, l2 = gather_luminance(reflectance, judgements)
+    ratio21, ratio12 = luminance_ratios(l1, l2)
+    return judgements, ratio21, ratio12
+
+
+def compute_whdr_sweep(reflectance, judgements, deltas, original_shape=None, anti_aliasing=False,
+                       return_sums=False, transform=None):
+    """compute_whdr for every equality threshold in `deltas`, returned as a list.
+
+    Luminances and their ratios are computed once and shared by all thresholds.
+    If `original_shape` is given, `reflectance` is sampled at that resolution as
+    in compute_whdr_sparse, applying `transform` to the pixels read. With
+    return_sums the WHDRSums of each threshold are returned instead;
+    whdr_from_sums turns them into compute_whdr results.
+    """
+    judgements, ratio21, ratio12 = judgement_ratios(reflectance, judgements, original_shape, anti_aliasing,
+                                                    transform)
+    sums = [whdr_sums_from_ratios(ratio21, ratio12, judgements, delta) for delta in deltas]
+    if return_sums:
+        return sums
+    return [whdr_from_sums(s) for s in sums]
+
+
+def evaluate_WHDR(prediction_R, targets, judgement_store=None, sparse=False):
     # num_images = prediction_S.size(0) # must be even number
     total_whdr = float(0)
     total_whdr_eq = float(0)
@@ -97,13 +255,20 @@ def evaluate_WHDR(prediction_R, targets):
 
         o_h = targets['oringinal_shape'][0].numpy()
         o_w = targets['oringinal_shape'][1].numpy()
-        # resize to original resolution
-        prediction_R_np = resize(prediction_R_np, (o_h[i] ,o_w[i]), order=1, preserve_range=True)
 
         # print(targets["judgements_path"][i])
-        # load Json judgement
-        judgements = json.load(open(targets["judgements_path"][i]))
-        (whdr, _), (whdr_eq, valid_eq), (whdr_ineq, valid_ineq) = compute_whdr(prediction_R_np, judgements, 0.1)
+        # load Json judgement, parsed once per process by the default cache
+        judgements = (judgement_store if judgement_store is not None else judgement_cache) \
+            .get_by_path(targets["judgements_path"][i])
+        if sparse:
+            # resize() below anti-aliases whenever it downsamples
+            (whdr, _), (whdr_eq, valid_eq), (whdr_ineq, valid_ineq) = \
+                compute_whdr_sparse(prediction_R_np, (o_h[i], o_w[i]), judgements, 0.1, anti_aliasing=True)
+        else:
+            # resize to original resolution
+            from skimage.transform import resize
+            prediction_R_np = resize(prediction_R_np, (o_h[i] ,o_w[i]), order=1, preserve_range=True)
+            (whdr, _), (whdr_eq, valid_eq), (whdr_ineq, valid_ineq) = compute_whdr(prediction_R_np, judgements, 0.1)
 
         total_whdr += whdr
         count += 1.
@@ -115,3 +280,154 @@ def evaluate_WHDR(prediction_R, targets):
             count_ineq += 1.
 
     return (total_whdr, count), (total_whdr_eq, count_eq), (total_whdr_ineq, count_ineq)
+
+
+# Judgements of a batch padded to the largest image: judgement pixel centers normalized
+# by the original image size (B, P), endpoint indices (B, K), weights and labels (B, K),
+# the mask of the real (not padded) comparisons and the original (height, width) (B, 2).
+JudgementBatch = namedtuple("JudgementBatch", ["point_y", "point_x", "point1", "point2", "weight", "darker", "mask",
+                                               "original_shape"])
+
+
+def prepare_judgement_batch(judgements_list, original_shapes, device=None):
+    """Build a JudgementBatch tensor set for evaluate_WHDR_batched.
+
+    `judgements_list` holds parsed json or JudgementArrays per sample and
+    `original_shapes` the (height, width) of the IIW input images.
+    """
+    import torch
+
+    judgements_list = [j if isinstance(j, JudgementArrays) else compile_judgements(j) for j in judgements_list]
+    num_points = max([1] + [len(j.point_x) for j in judgements_list])
+    num_comparisons = max([1] + [len(j.weight) for j in judgements_list])
+
+    batch_size = len(judgements_list)
+    point_y = np.zeros((batch_size, num_points))
+    point_x = np.zeros((batch_size, num_points))
+    point1 = np.zeros((batch_size, num_comparisons), dtype=np.int64)
+    point2 = np.zeros((batch_size, num_comparisons), dtype=np.int64)
+    weight = np.zeros((batch_size, num_comparisons))
+    darker = np.zeros((batch_size, num_comparisons), dtype=np.int64)
+    mask = np.zeros((batch_size, num_comparisons), dtype=bool)
+    for b, (j, (rows, cols)) in enumerate(zip(judgements_list, original_shapes)):
+        ys, xs = judgement_pixels(j, int(rows), int(cols))
+        # center of the judgement pixel in the original image, in [0, 1]
+        point_y[b, :len(ys)] = (ys + 0.5) / int(rows)
+        point_x[b, :len(xs)] = (xs + 0.5) / int(cols)
+        k = len(j.weight)
+        point1[b, :k] = j.point1
+        point2[b, :k] = j.point2
+        weight[b, :k] = j.weight
+        darker[b, :k] = j.darker
+        mask[b, :k] = True
+
+    original_shape = np.array([[int(rows), int(cols)] for rows, cols in original_shapes], dtype=np.int64)
+    return JudgementBatch(*[torch.as_tensor(a, device=device)
+                            for a in (point_y, point_x, point1, point2, weight, darker, mask, original_shape)])
+
+
+def _mirror_index_torch(idx, n):
+    # same boundary handling as _mirror_index in util.py
+    if n == 1:
+        return idx.new_zeros(idx.shape)
+    period = 2 * (n - 1)
+    idx = idx.abs() % period
+    return idx.where(idx <= n - 1, period - idx)
+
+
+def _gaussian_kernels_torch(sizes, original_sizes, device):
+    # offsets (K,) and per-sample weights (B, K) of the anti-aliasing filter of
+    # resize() along one axis, padded to the widest kernel of the batch
+    import torch
+
+    kernels = [util._gaussian_kernel1d(max(0.0, (size / original_size - 1) / 2))
+               for size, original_size in zip(sizes, original_sizes)]
+    radius = max(int(offsets[-1]) for offsets, _ in kernels)
+    weights = np.zeros((len(kernels), 2 * radius + 1))
+    for b, (offsets, k) in enumerate(kernels):
+        weights[b, offsets + radius] = k
+    return torch.arange(-radius, radius + 1, device=device), torch.as_tensor(weights, device=device)
+
+
+def whdr_batched(prediction_R, batch: JudgementBatch, delta=0.1, anti_aliasing=True):
+    """Per-sample WHDR of a (B, C, H, W) tensor resized to the original image sizes.
+
+    The judgement pixels are bilinearly interpolated from the prediction as in
+    resize(..., order=1), all on the prediction's device. With anti_aliasing the
+    gaussian pre-filter resize() applies to downsampled images is applied to the
+    neighbourhood of each judgement pixel, as in util.sample_resize.
+    Returns (whdr, whdr_eq, valid_eq, whdr_ineq, valid_ineq) tensors of shape (B,).
+    """
+    import torch
+
+    b, c, h, w = prediction_R.shape
+    r = batch.point_y * h - 0.5
+    col = batch.point_x * w - 0.5
+    r0 = r.floor()
+    c0 = col.floor()
+    fr = (r - r0).unsqueeze(1)
+    fc = (col - c0).unsqueeze(1)
+    r0 = r0.long()
+    c0 = c0.long()
+
+    flat = prediction_R.reshape(b, c, h * w)
+
+    if anti_aliasing:
+        original_shape = batch.original_shape.tolist()
+        ky, wy = _gaussian_kernels_torch([h] * b, [rows for rows, _ in original_shape], prediction_R.device)
+        kx, wx = _gaussian_kernels_torch([w] * b, [cols for _, cols in original_shape], prediction_R.device)
+
+        def pixel(ri, ci):
+            # gaussian-weighted (B, P, Ky, Kx) neighbourhood of every pixel
+            index = _mirror_index_torch(ri.unsqueeze(-1) + ky, h).unsqueeze(-1) * w \
+                + _mirror_index_torch(ci.unsqueeze(-1) + kx, w).unsqueeze(-2)
+            values = flat.gather(2, index.reshape(b, 1, -1).expand(b, c, index[0].numel())).double()
+            return torch.einsum('bcpij,bi,bj->bcp', values.reshape((b, c) + index.shape[1:]), wy, wx)
+    else:
+        def pixel(ri, ci):
+            index = _mirror_index_torch(ri, h) * w + _mirror_index_torch(ci, w)
+            return flat.gather(2, index.unsqueeze(1).expand(b, c, index.shape[1])).double()
+
+    values = (1 - fr) * (1 - fc) * pixel(r0, c0) + (1 - fr) * fc * pixel(r0, c0 + 1) \
+        + fr * (1 - fc) * pixel(r0 + 1, c0) + fr * fc * pixel(r0 + 1, c0 + 1)
+    # grayscale, in the precision of the prediction like the numpy path
+    lum = values.to(prediction_R.dtype).mean(dim=1)
+
+    l1 = lum.gather(1, batch.point1).clamp(min=1e-10)
+    l2 = lum.gather(1, batch.point2).clamp(min=1e-10)
+    alg_darker = torch.where(l2 / l1 > 1.0 + delta, DARKER_CODES['1'],
+                             torch.where(l1 / l2 > 1.0 + delta, DARKER_CODES['2'], DARKER_CODES['E']))
+
+    weight = batch.weight * batch.mask
+    error = (batch.darker != alg_darker) * weight
+    equal = batch.darker == DARKER_CODES['E']
+
+    weight_sum = weight.sum(1)
+    weight_equal_sum = (weight * equal).sum(1)
+    weight_inequal_sum = (weight * ~equal).sum(1)
+    whdr = error.sum(1) / weight_sum.clamp(min=1e-6)
+    whdr_eq = (error * equal).sum(1) / weight_equal_sum.clamp(min=1e-6)
+    whdr_ineq = (error * ~equal).sum(1) / weight_inequal_sum.clamp(min=1e-6)
+    return whdr, whdr_eq, weight_equal_sum > 1e-5, whdr_ineq, weight_inequal_sum > 1e-5
+
+
+def evaluate_WHDR_batched(prediction_R, targets, judgement_store=None, judgement_batch=None):
+    """Batched, on-device version of evaluate_WHDR with the same return value.
+
+    The judgements are taken from `judgement_batch` (see prepare_judgement_batch)
+    if given, otherwise they are read for targets["judgements_path"] from
+    `judgement_store` or the default JudgementCache. Like resize() in
+    evaluate_WHDR, predictions larger than the original image are anti-aliased.
+    """
+    if judgement_batch is None:
+        judgements_list = [(judgement_store if judgement_store is not None else judgement_cache).get_by_path(path)
+                           for path in targets["judgements_path"]]
+        o_h = targets['oringinal_shape'][0]
+        o_w = targets['oringinal_shape'][1]
+        judgement_batch = prepare_judgement_batch(judgements_list, list(zip(o_h.tolist(), o_w.tolist())),
+                                                  device=prediction_R.device)
+
+    whdr, whdr_eq, valid_eq, whdr_ineq, valid_ineq = whdr_batched(prediction_R, judgement_batch, 0.1)
+    return (whdr.sum().item(), float(whdr.numel())), \
+           ((whdr_eq * valid_eq).sum().item(), valid_eq.sum().item() * 1.), \
+           ((whdr_ineq * valid_ineq).sum().item(), valid_ineq.sum().item() * 1.)
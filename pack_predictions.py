@@ -0,0 +1,73 @@
+import argparse
+import os
+
+import h5py
+
+import prediction_loader
+from prediction_loader import PredictionLoader
+from compute_iiw_whdr import read_test_ids
+
+
+def pack_predictions(loader: PredictionLoader, ids, archive_path, space="srgb", compression=None):
+    """Write the predictions of `ids` to one HDF5 archive, a chunked dataset per id.
+
+    The archive is read back with prediction_loader.Packed_HDF5_Loader.
+    `compression` is passed to h5py, e.g. "gzip" or "lzf".
+    """
+    tmp_path = archive_path + ".tmp"
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs["space"] = space
+        for k, id in enumerate(ids):
+            pred_r = loader.get_pred_r(id, space)
+            dataset = f.create_dataset(str(id), data=pred_r, chunks=True, compression=compression)
+            pred_key = loader.get_pred_key(id)
+            if pred_key is not None:
+                dataset.attrs["pred_key"] = pred_key
+            if k % 100 == 0:
+                print(f"Pack {k}/{len(ids)}: {id}")
+    os.replace(tmp_path, archive_path)
+    print(f"Packed {len(ids)} predictions into {archive_path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default="./iiw_test_img_batch.p",
+        metavar="FILE",
+        help="Path to test list file",
+        type=str,
+    )
+    parser.add_argument(
+        "--loader",
+        default="Li_2018_CGI_Loader",
+        metavar="CLASS",
+        help="PredictionLoader class in prediction_loader.py",
+        type=str,
+    )
+    parser.add_argument(
+        "--dir",
+        required=True,
+        metavar="FILE",
+        help="Result directory the loader is constructed with",
+        type=str,
+    )
+    parser.add_argument(
+        "--out",
+        required=True,
+        metavar="FILE",
+        help="Path of the HDF5 archive to write",
+        type=str,
+    )
+    parser.add_argument(
+        "--compression",
+        default=None,
+        choices=["gzip", "lzf"],
+        help="Optional dataset compression",
+        type=str,
+    )
+    args = parser.parse_args()
+
+    loader = getattr(prediction_loader, args.loader)(args.dir)
+    ids = [id for _, _, id in read_test_ids(args.file)]
+    pack_predictions(loader, ids, args.out, compression=args.compression)
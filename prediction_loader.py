@@ -1,8 +1,8 @@
 from abc import ABC, abstractmethod
 import os
-import h5py
 import numpy as np
 
+import image_cache
 import util
 
 
@@ -10,6 +10,12 @@ class PredictionLoader(ABC):
     raw_dir = None
     image_dir = None
     img_postfix = None
+    # color spaces get_pred_r can return
+    spaces = ("srgb",)
+    # evaluate without the images that have no prediction file, instead of failing
+    skip_missing = False
+    # score the prediction at its own resolution instead of resizing it to the input image
+    native_resolution = False
 
     @abstractmethod
     def get_pred_r(self, id, space):
@@ -21,6 +27,28 @@ class PredictionLoader(ABC):
         '''Please implement in subclass'''
         raise NotImplemented
 
+    def get_pred_r_lazy(self, id, space):
+        """(array, pixel_transform) such that pixel_transform, applied to any pixels
+        read from array, gives the values of get_pred_r(id, space) at those pixels.
+
+        Loaders override this to return memory-mapped data and convert only the
+        pixels that are actually read (see util.sample_resize). pixel_transform
+        is None if the array already holds the final values.
+        """
+        return self.get_pred_r(id, space), None
+
+    def get_pred_r_path(self, id):
+        """Path of the file get_pred_r reads, used to detect changed predictions"""
+        return self.get_pred_rs_img_path(id)[0]
+
+    def get_pred_key(self, id):
+        """mtime and size of the prediction file of `id`, or None if it does not exist"""
+        try:
+            st = os.stat(self.get_pred_r_path(id))
+        except OSError:
+            return None
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
     def set_img_dir(self, img_dir, img_postfix):
         assert img_postfix in ["png", "jpg", "jpeg"]
         self.image_dir = img_dir
@@ -34,9 +62,13 @@ class Li_2018_CGI_Loader(PredictionLoader):
         self.image_dir = os.path.join(self.dir, "release_iiw_images")
         self.img_postfix = "png"
 
+    def get_pred_r_path(self, id):
+        return os.path.join(self.raw_dir, f"{id}.png.h5")
+
     def get_pred_r(self, id, space):
         assert space in ["srgb"]
-        pred_path = os.path.join(self.raw_dir, f"{id}.png.h5")
+        pred_path = self.get_pred_r_path(id)
+        import h5py
         hdf5_file_read = h5py.File(pred_path, 'r')
         pred_R = hdf5_file_read.get('/prediction/R')
         pred_R = np.array(pred_R)
@@ -52,88 +84,180 @@ class Li_2018_CGI_Loader(PredictionLoader):
 
 
 class Luo_2020_NIID_Net_Loader(PredictionLoader):
-    def __init__(self, dir):
+    def __init__(self, dir, mmap_mode=None):
         self.dir = dir
         self.raw_dir = os.path.join(self.dir, "final_raw")
         self.image_dir = os.path.join(self.dir, "SAW_pred_imgs")
         self.img_postfix = "png"
+        self.mmap_mode = mmap_mode
+
+    def get_pred_r_path(self, id):
+        return os.path.join(self.raw_dir, f"{id}-r.npy")
 
     def get_pred_r(self, id, space):
         assert space in ["srgb"]
-        pred_R_path = os.path.join(self.raw_dir, f"{id}-r.npy")
-        pred_R = np.load(pred_R_path).astype(np.float32)
-        pred_R = util.rgb_to_srgb(pred_R)
+        pred_R_path = self.get_pred_r_path(id)
+        # no copy if the file is float32 already
+        pred_R = np.asarray(np.load(pred_R_path, mmap_mode=self.mmap_mode), dtype=np.float32)
+        # convert in place unless the array is a view of the memory-mapped file
+        pred_R = util.rgb_to_srgb(pred_R, out=pred_R if pred_R.flags.owndata else None)
         return pred_R
 
+    def get_pred_r_lazy(self, id, space):
+        assert space in ["srgb"]
+        pred_R = np.load(self.get_pred_r_path(id), mmap_mode=self.mmap_mode or 'r')
+        return pred_R, self._to_srgb
+
+    @staticmethod
+    def _to_srgb(pixels):
+        pixels = np.asarray(pixels, dtype=np.float32)
+        return util.rgb_to_srgb(pixels, out=pixels if pixels.flags.owndata else None)
+
     def get_pred_rs_img_path(self, id):
         r_img_path = os.path.join(self.image_dir, f"{id}_R.{self.img_postfix}")
         s_img_path = os.path.join(self.image_dir, f"{id}_S.{self.img_postfix}")
         return r_img_path, s_img_path
 
 
-class CRefNet(PredictionLoader):
-    def __init__(self, dir):
-        self.dir = dir
-        self.image_dir = os.path.join(self.dir, "split")
-        self.img_postfix = "jpg"
+class ImageBackedLoader(PredictionLoader):
+    """Loader of predictions stored as sRGB images,
+    <image_dir>/<id><r_suffix>.<img_postfix> and <id><s_suffix> for shading.
 
-    def get_pred_r(self, id, space):
-        '''Please implement in subclass'''
-        raise NotImplemented
+    get_pred_r decodes the reflectance image through `cache` (by default
+    image_cache.get_default_cache(), e.g. a DiskImageCache), so an image is
+    only decoded again once it changed or was evicted.
+    """
+    r_suffix = "-r"
+    s_suffix = "-s"
+    spaces = ("srgb", "rgb")
+
+    def __init__(self, image_dir, img_postfix, cache=None):
+        self.image_dir = image_dir
+        self.img_postfix = img_postfix
+        # get_pred_r reads from here, also after set_img_dir pointed image_dir to copies
+        self.pred_dir = image_dir
+        self.pred_postfix = img_postfix
+        self.cache = cache
 
     def get_pred_rs_img_path(self, id):
-        r_img_path = os.path.join(self.image_dir, f"{id}_r.{self.img_postfix}")
-        s_img_path = os.path.join(self.image_dir, f"{id}_s.{self.img_postfix}")
+        r_img_path = os.path.join(self.image_dir, f"{id}{self.r_suffix}.{self.img_postfix}")
+        s_img_path = os.path.join(self.image_dir, f"{id}{self.s_suffix}.{self.img_postfix}")
         return r_img_path, s_img_path
 
+    def get_pred_r_path(self, id):
+        return os.path.join(self.pred_dir, f"{id}{self.r_suffix}.{self.pred_postfix}")
 
-class Wang_2019_Discriminative_Loader(PredictionLoader):
-    def __init__(self, dir):
-        self.dir = dir
-        self.image_dir = os.path.join(self.dir, "test-imgs_ep12_results")
-        self.img_postfix = "png"
+    def get_pred_r_lazy(self, id, space):
+        assert space in self.spaces
+        cache = self.cache if self.cache is not None else image_cache.get_default_cache()
+        image = cache.get(self.get_pred_r_path(id))
+        return image, self._to_srgb if space == "srgb" else self._to_rgb
 
     def get_pred_r(self, id, space):
-        '''Please implement in subclass'''
-        raise NotImplemented
+        image, transform = self.get_pred_r_lazy(id, space)
+        return transform(image)
+
+    @staticmethod
+    def _to_srgb(pixels):
+        # the stored integers are sRGB values already
+        pixels = np.asarray(pixels)
+        return np.multiply(pixels, np.float32(1.0 / np.iinfo(pixels.dtype).max), dtype=np.float32)
+
+    # {integer dtype: table of _to_srgb then util.srgb_to_linear of every value}
+    _linear_luts = {}
+
+    @staticmethod
+    def _to_rgb(pixels):
+        # a lookup gives the same values as converting every pixel, at a fraction of the cost
+        pixels = np.asarray(pixels)
+        lut = ImageBackedLoader._linear_luts.get(pixels.dtype)
+        if lut is None:
+            values = np.arange(np.iinfo(pixels.dtype).max + 1, dtype=pixels.dtype)
+            lut = util.srgb_to_linear(ImageBackedLoader._to_srgb(values))
+            ImageBackedLoader._linear_luts[pixels.dtype] = lut
+        return np.take(lut, pixels)
+
+
+class CRefNet(ImageBackedLoader):
+    r_suffix = "_r"
+    s_suffix = "_s"
+
+    def __init__(self, dir, cache=None):
+        self.dir = dir
+        super().__init__(os.path.join(self.dir, "split"), "jpg", cache)
 
-    def get_pred_rs_img_path(self, id):
-        r_img_path = os.path.join(self.image_dir, f"{id}_r.{self.img_postfix}")
-        s_img_path = os.path.join(self.image_dir, f"{id}_sr.{self.img_postfix}")
-        return r_img_path, s_img_path
 
+class Wang_2019_Discriminative_Loader(ImageBackedLoader):
+    r_suffix = "_r"
+    s_suffix = "_sr"
 
-class Bi_2015_L1smoothing_Loader(PredictionLoader):
-    def __init__(self, dir):
+    def __init__(self, dir, cache=None):
         self.dir = dir
-        self.image_dir = os.path.join(self.dir, "our_result")
-        self.img_postfix = "png"
+        super().__init__(os.path.join(self.dir, "test-imgs_ep12_results"), "png", cache)
 
-    def get_pred_r(self, id, space):
-        '''Please implement in subclass'''
-        raise NotImplemented
 
-    def get_pred_rs_img_path(self, id):
-        r_img_path = os.path.join(self.image_dir, f"{id}-r.{self.img_postfix}")
-        s_img_path = os.path.join(self.image_dir, f"{id}-s.{self.img_postfix}")
-        return r_img_path, s_img_path
+class Bi_2015_L1smoothing_Loader(ImageBackedLoader):
+    def __init__(self, dir, cache=None):
+        self.dir = dir
+        super().__init__(os.path.join(self.dir, "our_result"), "png", cache)
 
 
-class General_Loader(PredictionLoader):
-    def __init__(self, dir, img_postfix="png"):
+class General_Loader(ImageBackedLoader):
+    """Decompositions stored as sRGB <id>-r.<postfix> / <id>-s.<postfix> images in one
+    directory, e.g. those of iiw-decompositions/download_images.py"""
+    def __init__(self, dir, img_postfix="png", cache=None):
         assert img_postfix in ["png", "jpeg", "jpg"]
         self.dir = dir
-        self.image_dir = self.dir
-        self.img_postfix = img_postfix
+        super().__init__(self.dir, img_postfix, cache)
+
+
+class Packed_HDF5_Loader(PredictionLoader):
+    """Reads predictions from a single HDF5 archive written by pack_predictions.py.
+
+    The archive holds one dataset per image id. The file is opened once per
+    process and kept open, instead of opening one file per image.
+    """
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.file = None
+        self.pid = None
+
+    def _get_file(self):
+        # h5py handles must not be shared with forked worker processes
+        if self.file is None or self.pid != os.getpid():
+            import h5py
+            self.file = h5py.File(self.archive_path, 'r')
+            self.pid = os.getpid()
+        return self.file
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["file"] = None
+        return state
 
     def get_pred_r(self, id, space):
-        '''Please implement in subclass'''
-        raise NotImplemented
+        f = self._get_file()
+        assert space == f.attrs["space"]
+        return f[str(id)][()]
 
     def get_pred_rs_img_path(self, id):
-        r_img_path = os.path.join(self.image_dir, f"{id}-r.{self.img_postfix}")
-        s_img_path = os.path.join(self.image_dir, f"{id}-s.{self.img_postfix}")
-        return r_img_path, s_img_path
+        raise NotImplementedError("Packed archives only contain the raw reflectance predictions")
+
+    def get_pred_r_path(self, id):
+        return self.archive_path
+
+    def get_pred_key(self, id):
+        # key of the source prediction, recorded when the archive was packed
+        dataset = self._get_file().get(str(id))
+        if dataset is None:
+            return None
+        return dataset.attrs.get("pred_key")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 
 class InputLoader(object):
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+from metrics_iiw import WHDRSums, whdr_from_sums
+
+
+class ResultStore(object):
+    """Per-image WHDR results kept in a columnar .npz file.
+
+    Rows are keyed by (method, threshold, image id) and remember the keys of the
+    prediction file (see PredictionLoader.get_pred_key) and of the judgement file
+    they were computed from, so a rerun only has to score the images whose
+    prediction or judgements changed. The file also records the scoring mode
+    (color space, sparse or dense) of its rows, see set_mode.
+    """
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.mode = None
+        # (method, threshold, id) -> (pred_key, judgement_key, WHDRSums)
+        self.rows = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with np.load(self.path) as f:
+            columns = dict(f)
+        if int(columns["version"]) != self.version:
+            return
+        self.mode = str(columns["mode"])
+        sums = zip(*[columns[field].tolist() for field in WHDRSums._fields])
+        for method, threshold, id, pred_key, judgement_key, s in zip(
+                columns["method"].tolist(), columns["threshold"].tolist(), columns["id"].tolist(),
+                columns["pred_key"].tolist(), columns["judgement_key"].tolist(), sums):
+            self.rows[(method, threshold, id)] = (pred_key, judgement_key, WHDRSums(*s))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def set_mode(self, mode):
+        """Score in `mode` from now on, dropping the rows stored in another mode"""
+        if self.mode is not None and self.mode != mode and self.rows:
+            print(f"Stored results are for {self.mode}, not {mode}; scoring them again")
+            self.rows.clear()
+        self.mode = mode
+
+    def get(self, method, threshold, id, pred_key, judgement_key):
+        """Stored WHDRSums, or None if missing or computed from another prediction or judgement file"""
+        row = self.rows.get((method, threshold, id))
+        if row is None or pred_key is None or row[0] != pred_key or row[1] != judgement_key:
+            return None
+        return row[2]
+
+    def put(self, method, threshold, id, pred_key, judgement_key, sums):
+        self.rows[(method, threshold, id)] = (pred_key, judgement_key, sums)
+
+    def save(self):
+        keys = list(self.rows.keys())
+        values = [self.rows[k] for k in keys]
+        results = [whdr_from_sums(s) for _, _, s in values]
+        columns = {
+            "version": np.array(self.version),
+            "mode": np.array(self.mode if self.mode is not None else "", dtype=str),
+            "method": np.array([k[0] for k in keys], dtype=str),
+            "threshold": np.array([k[1] for k in keys], dtype=np.float64),
+            "id": np.array([k[2] for k in keys], dtype=str),
+            "pred_key": np.array([v[0] for v in values], dtype=str),
+            "judgement_key": np.array([v[1] for v in values], dtype=str),
+        }
+        for i, field in enumerate(WHDRSums._fields):
+            columns[field] = np.array([v[2][i] for v in values], dtype=np.float64)
+        # the per-image results, for reading the store without recomputing them
+        for i, name in enumerate(["whdr", "whdr_eq", "whdr_ineq"]):
+            columns[name] = np.array([r[i][0] if r is not None else np.nan for r in results], dtype=np.float64)
+            columns[name.replace("whdr", "valid")] = np.array([r is not None and bool(r[i][1]) for r in results])
+
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, **columns)
+        os.replace(tmp_path, self.path)
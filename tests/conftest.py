@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "iiw-decompositions")]
+
+
+@pytest.fixture(scope="session")
+def iiw_tree(tmp_path_factory):
+    """(root, ids) of a small synthetic IIW tree with Li 2018 (<root>/li) and
+    Luo 2020 (<root>/luo) predictions, see benchmark_whdr.make_dataset"""
+    cv2 = pytest.importorskip("cv2")
+    pytest.importorskip("h5py")
+    pytest.importorskip("skimage")
+    import numpy as np
+    from benchmark_whdr import make_dataset
+
+    root = str(tmp_path_factory.mktemp("iiw"))
+    ids = make_dataset(root, num_images=12, num_points=40, num_comparisons=80, pred_shape=(24, 32),
+                       original_shape=(45, 60))
+    for i, id in enumerate(ids):
+        # mixed input sizes, so predictions are both up- and downsampled
+        shape = (45, 60) if i % 2 else (18, 20)
+        cv2.imwrite(os.path.join(root, "data", f"{id}.png"), np.zeros(shape + (3,), dtype=np.uint8))
+    return root, ids
@@ -0,0 +1,68 @@
+import itertools
+import json
+import math
+
+import numpy as np
+
+from average_meter import WHDRAverageMeter
+from compute_iiw_whdr import merge_meter_files, save_meters
+
+
+def _image_results(rng, num_images):
+    # metrics_iiw.whdr_from_sums results, with images without equal or inequal comparisons
+    return [((float(rng.uniform()), True),
+             (float(rng.uniform()), bool(rng.uniform() > 0.3)),
+             (float(rng.uniform()), bool(rng.uniform() > 0.1))) for _ in range(num_images)]
+
+
+def _meter(results, name="m"):
+    meter = WHDRAverageMeter(name)
+    for result in results:
+        meter.update_result(result)
+    return meter
+
+
+def test_merged_shards_equal_single_pass():
+    results = _image_results(np.random.default_rng(0), 300)
+    expected = _meter(results).get_results()
+    shards = [results[:17], results[17:160], results[160:161], results[161:]]
+    for order in itertools.permutations(shards):
+        merged = WHDRAverageMeter("m")
+        for shard in order:
+            merged.merge(_meter(shard))
+        assert merged.get_results() == expected
+    # the single pass in another order rounds the same
+    assert _meter(results[::-1]).get_results() == expected
+
+
+def test_meter_files_merge_to_single_pass(tmp_path):
+    results = _image_results(np.random.default_rng(1), 100)
+    paths = []
+    for k, shard in enumerate([results[:40], results[40:]]):
+        paths.append(str(tmp_path / f"{k}.json"))
+        save_meters(paths[-1], {"m": [_meter(shard)]}, [0.1])
+    assert merge_meter_files(paths[::-1]) == {"m": {0.1: _meter(results).get_results()}}
+
+
+def test_json_round_trip():
+    meter = _meter(_image_results(np.random.default_rng(2), 50))
+    restored = WHDRAverageMeter.from_json(meter.to_json())
+    assert restored.name == meter.name
+    assert restored.state_dict() == meter.state_dict()
+    assert restored.get_results() == meter.get_results()
+    assert json.loads(restored.to_json()) == json.loads(meter.to_json())
+
+
+def test_valid_counts():
+    results = _image_results(np.random.default_rng(3), 200)
+    meter = _meter(results)
+    valid_eq = [r[1][0] for r in results if r[1][1]]
+    valid_ineq = [r[2][0] for r in results if r[2][1]]
+    assert meter.whdr_meter.count == len(results)
+    assert meter.whdr_eq_meter.count == len(valid_eq)
+    assert meter.whdr_ineq_meter.count == len(valid_ineq)
+    r = meter.get_results()
+    # the correctly rounded sums, divided by the counts
+    assert r.WHDR == math.fsum(r[0][0] for r in results) / len(results)
+    assert r.WHDR_eq == math.fsum(valid_eq) / len(valid_eq)
+    assert r.WHDR_ineq == math.fsum(valid_ineq) / len(valid_ineq)
@@ -0,0 +1,142 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+from download_images import Download
+
+FILES = {"/a.png": bytes(range(256)) * 40, "/b.png": b"\x89PNG" * 1000}
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, as the pooled connections of Download expect
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.requests.append((self.path, range_header))
+        if self.path == "/redirect":
+            # a redirect without a Location header
+            self.send_response(302)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = FILES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        if range_header is None:
+            self.send_response(200)
+        else:
+            start = int(range_header[len("bytes="):].rstrip("-"))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            body = body[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    RangeHandler.requests = []
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _jobs(server, tmp_path):
+    return [(server + name, str(tmp_path / name[1:])) for name in sorted(FILES)]
+
+
+def test_download_and_manifest_skip(server, tmp_path):
+    jobs = _jobs(server, tmp_path)
+    manifest = str(tmp_path / "manifest.json")
+    assert Download(jobs, manifest).run(2) == []
+    for name, (_, filename) in zip(sorted(FILES), jobs):
+        with open(filename, "rb") as f:
+            assert f.read() == FILES[name]
+        assert not os.path.exists(filename + ".part")
+
+    # a second run finds every file in the manifest and sends no request
+    RangeHandler.requests = []
+    d = Download(jobs, manifest)
+    assert [d.download(i) for i in range(len(jobs))] == [False, False]
+    assert RangeHandler.requests == []
+
+
+def test_resume_partial_file(server, tmp_path):
+    jobs = _jobs(server, tmp_path)
+    _, filename = jobs[0]
+    with open(filename + ".part", "wb") as f:
+        f.write(FILES["/a.png"][:1000])
+
+    d = Download(jobs[:1], str(tmp_path / "manifest.json"))
+    assert d.download(0)
+    assert RangeHandler.requests == [("/a.png", "bytes=1000-")]
+    with open(filename, "rb") as f:
+        assert f.read() == FILES["/a.png"]
+    assert d.manifest.is_complete(filename)
+    assert d.manifest.entries[filename]["sha256"] == hashlib.sha256(FILES["/a.png"]).hexdigest()
+
+
+def test_complete_partial_file(server, tmp_path):
+    jobs = _jobs(server, tmp_path)
+    _, filename = jobs[1]
+    with open(filename + ".part", "wb") as f:
+        f.write(FILES["/b.png"])
+
+    d = Download(jobs[1:], str(tmp_path / "manifest.json"))
+    assert d.download(0)
+    assert RangeHandler.requests == [("/b.png", f"bytes={len(FILES['/b.png'])}-")]
+    with open(filename, "rb") as f:
+        assert f.read() == FILES["/b.png"]
+    assert not os.path.exists(filename + ".part")
+    assert d.manifest.is_complete(filename)
+
+
+def _touch(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_copied_files_are_checked_by_checksum(server, tmp_path):
+    jobs = _jobs(server, tmp_path)
+    manifest = str(tmp_path / "manifest.json")
+    assert Download(jobs, manifest).run(1) == []
+    (_, unchanged), (_, corrupted) = jobs
+    _touch(unchanged)
+    with open(corrupted, "r+b") as f:
+        f.write(b"x")
+    _touch(corrupted)
+
+    RangeHandler.requests = []
+    d = Download(jobs, manifest)
+    assert [d.download(i) for i in range(len(jobs))] == [False, True]
+    assert RangeHandler.requests == [("/b.png", None)]
+    with open(corrupted, "rb") as f:
+        assert f.read() == FILES["/b.png"]
+    # the new mtime of the unchanged file is recorded, so the next check is a stat again
+    assert d.manifest.entries[unchanged]["mtime_ns"] == os.stat(unchanged).st_mtime_ns
+
+
+def test_redirect_without_location(server, tmp_path):
+    d = Download([(server + "/redirect", str(tmp_path / "r.png"))], str(tmp_path / "manifest.json"), retries=2)
+    with pytest.raises(IOError, match="without a Location"):
+        d.download(0)
+    assert d.run(1) == d.jobs
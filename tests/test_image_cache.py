@@ -0,0 +1,144 @@
+import os
+import pickle
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+import image_cache
+import util
+
+
+def _nbytes(value):
+    return value.nbytes
+
+
+def test_byte_lru_cache_eviction():
+    cache = util.ByteLRUCache(_nbytes, max_bytes=100)
+    for key in "abc":
+        cache.put(key, np.zeros(4))  # 32 bytes each
+    assert list(cache.entries) == ["a", "b", "c"] and cache.nbytes == 96
+    assert cache.get("a") is not None  # now the most recently used
+    cache.put("d", np.zeros(4))
+    assert list(cache.entries) == ["c", "a", "d"] and cache.nbytes == 96
+    assert cache.get("b") is None and cache.get("b", 1) == 1
+
+    # replacing an entry counts its new size only
+    cache.put("c", np.zeros(2))
+    assert list(cache.entries) == ["a", "d", "c"] and cache.nbytes == 80
+    # the most recent entry is kept even if it exceeds the limit alone
+    cache.put("e", np.zeros(20))
+    assert list(cache.entries) == ["e"] and cache.nbytes == 160
+
+    cache.set_limits(max_bytes=None, max_items=2)
+    for key in "fg":
+        cache.put(key, np.zeros(1))
+    assert list(cache.entries) == ["f", "g"] and cache.nbytes == 16
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_byte_lru_cache_pickles_empty():
+    cache = util.ByteLRUCache(_nbytes, max_bytes=100, max_items=3)
+    cache.put("a", np.zeros(4))
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy) == 0 and copy.nbytes == 0
+    assert (copy.max_bytes, copy.max_items) == (100, 3)
+    copy.put("b", np.zeros(4))
+    assert list(copy.entries) == ["b"]
+
+
+@pytest.fixture
+def images(tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"{i}.png"))
+        cv2.imwrite(paths[-1], rng.integers(0, 256, (10, 20, 3), dtype=np.uint8))
+    return paths
+
+
+@pytest.fixture
+def count_reads(monkeypatch):
+    reads = []
+    read_image = image_cache.read_image
+
+    def counted(path):
+        reads.append(path)
+        return read_image(path)
+
+    monkeypatch.setattr(image_cache, "read_image", counted)
+    return reads
+
+
+def _touch(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_decoded_image_cache(images, count_reads):
+    cache = image_cache.DecodedImageCache(max_bytes=2 * 600)
+    image = cache.get(images[0])
+    assert cache.get(images[0]) is image and not image.flags.writeable
+    for path in images[1:]:
+        cache.get(path)
+    assert len(cache) == 2 and count_reads == images
+    _touch(images[2])
+    cache.get(images[2])
+    assert count_reads == images + [images[2]]
+
+
+def test_disk_image_cache_reuses_mmaps(images, tmp_path, count_reads):
+    cache_dir = str(tmp_path / "cache")
+    cache = image_cache.DiskImageCache(cache_dir)
+    image = cache.get(images[0])
+    again = cache.get(images[0])
+    assert isinstance(again, np.memmap)
+    np.testing.assert_array_equal(again, image)
+    assert count_reads == images[:1]
+
+    # entries persist for other instances and processes
+    assert isinstance(image_cache.DiskImageCache(cache_dir).get(images[0]), np.memmap)
+    assert count_reads == images[:1] and len(cache) == 1
+    _touch(images[0])
+    cache.get(images[0])
+    assert count_reads == [images[0]] * 2 and len(cache) == 2
+
+
+def test_disk_image_cache_eviction(images, tmp_path):
+    cache = image_cache.DiskImageCache(str(tmp_path / "cache"), max_bytes=2 * 800)
+    for path in images:
+        cache.get(path)
+    assert len(cache) == 2
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.cache_dir == cache.cache_dir and len(copy) == 2
+
+
+def test_spawned_workers_use_the_default_cache(iiw_tree, tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    root, ids = iiw_tree
+    pred_dir = tmp_path / "general"
+    pred_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for id in ids:
+        cv2.imwrite(str(pred_dir / f"{id}-r.png"), rng.integers(1, 256, (24, 32, 3), dtype=np.uint8))
+    cache_dir = str(tmp_path / "cache")
+    script = textwrap.dedent(f"""
+        import multiprocessing
+        import image_cache
+        from prediction_loader import General_Loader
+        from whdr_pipeline import evaluate_stream
+
+        if __name__ == "__main__":
+            multiprocessing.set_start_method("spawn")
+            image_cache.set_default_cache(image_cache.DiskImageCache({cache_dir!r}))
+            loaders = {{"general": General_Loader({str(pred_dir)!r})}}
+            results = list(evaluate_stream({ids!r}, {root!r}, [0.1], loaders, num_workers=2))
+            assert len(results) == {len(ids)}
+    """)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script], cwd=repo_dir, check=True)
+    assert len(image_cache.DiskImageCache(cache_dir)) == len(ids)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from image_meta import ImageSizeIndex, read_image_size
+
+cv2 = pytest.importorskip("cv2")
+
+
+def _write(path, shape, dtype=np.uint8, params=()):
+    image = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, shape, dtype=dtype)
+    assert cv2.imwrite(str(path), image, list(params))
+    return str(path)
+
+
+@pytest.mark.parametrize("name, shape, dtype, params", [
+    ("rgb.png", (37, 53, 3), np.uint8, ()),
+    ("gray.png", (64, 20), np.uint8, ()),
+    ("rgb16.png", (12, 300, 3), np.uint16, ()),
+    ("baseline.jpg", (341, 512, 3), np.uint8, ()),
+    ("progressive.jpg", (97, 61, 3), np.uint8, (cv2.IMWRITE_JPEG_PROGRESSIVE, 1)),
+    ("gray.jpg", (8, 1000), np.uint8, ()),
+])
+def test_read_image_size_matches_decode(tmp_path, name, shape, dtype, params):
+    path = _write(tmp_path / name, shape, dtype, params)
+    assert read_image_size(path) == cv2.imread(path, cv2.IMREAD_UNCHANGED).shape[:2]
+
+
+@pytest.mark.parametrize("name", ["image.png", "image.jpg"])
+def test_truncated_header(tmp_path, name):
+    path = _write(tmp_path / name, (20, 30, 3))
+    with open(path, "rb") as f:
+        data = f.read()
+    # every cut before the size fields raises ValueError, as callers expect
+    truncated = str(tmp_path / f"truncated_{name}")
+    checked = 0
+    for length in range(2, 400):
+        with open(truncated, "wb") as f:
+            f.write(data[:length])
+        try:
+            size = read_image_size(truncated)
+        except ValueError:
+            checked += 1
+            continue
+        assert size == (20, 30)
+    assert checked > 0
+
+
+def test_unsupported_format(tmp_path):
+    path = tmp_path / "image.bmp"
+    path.write_bytes(b"BM" + bytes(100))
+    with pytest.raises(ValueError):
+        read_image_size(str(path))
+
+
+def test_image_size_index(tmp_path):
+    path = _write(tmp_path / "image.png", (11, 13, 3))
+    index_path = str(tmp_path / "sizes.json")
+    index = ImageSizeIndex(index_path)
+    assert index.get("1", path) == (11, 13)
+    index.save()
+    # later lookups are served from the saved index without the image
+    assert ImageSizeIndex(index_path).get("1", str(tmp_path / "missing.png")) == (11, 13)
@@ -0,0 +1,79 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from image_meta import ImageSizeIndex
+from judgement_store import JudgementStore
+from metrics_iiw import compile_judgements
+
+
+def _write_judgements(path, rng, num_points=20, num_comparisons=40):
+    points = [{"id": i, "x": float(rng.uniform()), "y": float(rng.uniform()), "opaque": bool(rng.uniform() > 0.1)}
+              for i in range(num_points)]
+    comparisons = [{"point1": int(p1), "point2": int(p2), "darker": str(rng.choice(["1", "2", "E", "X"])),
+                    "darker_score": float(rng.uniform(-0.2, 1))}
+                   for p1, p2 in (rng.choice(num_points, 2, replace=False) for _ in range(num_comparisons))]
+    with open(path, "w") as f:
+        json.dump({"intrinsic_points": points, "intrinsic_comparisons": comparisons}, f)
+
+
+@pytest.fixture
+def judgement_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for id in ["101", "102", "205"]:
+        _write_judgements(str(data_dir / f"{id}.json"), rng)
+    return str(data_dir)
+
+
+def _assert_same(store, judgement_dir):
+    for id in ["101", "102", "205"]:
+        with open(os.path.join(judgement_dir, f"{id}.json")) as f:
+            expected = compile_judgements(json.load(f))
+        for field, a, b in zip(expected._fields, store.get(id), expected):
+            np.testing.assert_array_equal(a, b, err_msg=field)
+
+
+def test_compile_load_and_invalidate(judgement_dir, capsys):
+    store = JudgementStore(judgement_dir)
+    assert "Compiling 3" in capsys.readouterr().out
+    assert len(store) == 3 and "102" in store
+    _assert_same(store, judgement_dir)
+
+    # a second store reads the cache
+    store = JudgementStore(judgement_dir)
+    assert capsys.readouterr().out == ""
+    _assert_same(store, judgement_dir)
+
+    # a changed json file is compiled again
+    path = os.path.join(judgement_dir, "102.json")
+    _write_judgements(path, np.random.default_rng(1), num_comparisons=55)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    store = JudgementStore(judgement_dir)
+    out = capsys.readouterr().out
+    assert "out of date" in out and "Compiling 3" in out
+    _assert_same(store, judgement_dir)
+    assert store.get_key("102") == f"{os.stat(path).st_mtime_ns}-{os.stat(path).st_size}"
+
+
+def test_unwritable_cache_is_kept_in_memory(judgement_dir, tmp_path, capsys):
+    cache_path = str(tmp_path / "missing" / "judgements_cache.npz")
+    store = JudgementStore(judgement_dir, cache_path)
+    assert "keeping it in memory" in capsys.readouterr().out
+    assert not os.path.exists(cache_path)
+    _assert_same(store, judgement_dir)
+
+
+def test_unwritable_image_size_index(tmp_path, capsys):
+    index = ImageSizeIndex(str(tmp_path / "missing" / "image_sizes.json"))
+    index.sizes["1"] = (3, 4)
+    index.modified = True
+    index.save()
+    assert "keeping it in memory" in capsys.readouterr().out
+    assert index.index_path is None
+    index.save()
+    assert index.sizes == {"1": (3, 4)}
@@ -0,0 +1,74 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from loader_registry import DEFAULT_LOADERS, LoaderRegistry, loader_class
+from prediction_loader import General_Loader, Luo_2020_NIID_Net_Loader
+
+
+class CountingLoader(General_Loader):
+    constructed = []
+
+    def __init__(self, dir, img_postfix="png"):
+        CountingLoader.constructed.append(dir)
+        super().__init__(dir, img_postfix)
+
+
+def test_from_file_resolves_relative_paths(tmp_path):
+    config_dir = tmp_path / "configs"
+    config_dir.mkdir()
+    specs = {"luo": {"class": "Luo_2020_NIID_Net_Loader", "path": "../results/luo", "options": {"mmap_mode": "r"}},
+             "absolute": {"class": "General_Loader", "path": str(tmp_path / "general")}}
+    (config_dir / "loaders.json").write_text(json.dumps(specs))
+
+    registry = LoaderRegistry.from_file(str(config_dir / "loaders.json"))
+    assert list(registry) == ["luo", "absolute"]
+    luo = registry["luo"]
+    assert isinstance(luo, Luo_2020_NIID_Net_Loader) and luo.mmap_mode == "r"
+    assert os.path.normpath(luo.dir) == str(tmp_path / "results" / "luo")
+    assert registry["absolute"].dir == str(tmp_path / "general")
+
+
+def test_from_file_needs_class_and_path(tmp_path):
+    (tmp_path / "loaders.json").write_text(json.dumps({"bad": {"path": "x"}}))
+    with pytest.raises(ValueError, match="needs a class and a path"):
+        LoaderRegistry.from_file(str(tmp_path / "loaders.json"))
+
+
+def test_loaders_are_constructed_on_first_lookup():
+    CountingLoader.constructed = []
+    registry = LoaderRegistry({"a": {"class": f"{__name__}:CountingLoader", "path": "/a"},
+                               "b": {"class": f"{__name__}:CountingLoader", "path": "/b", "options": {"img_postfix": "jpg"}}})
+    assert "a" in registry and len(registry) == 2
+    assert CountingLoader.constructed == []
+    b = registry["b"]
+    assert CountingLoader.constructed == ["/b"] and b.img_postfix == "jpg"
+    assert registry["b"] is b
+    assert CountingLoader.constructed == ["/b"]
+
+    loader = General_Loader("/c")
+    registry.register("c", loader)
+    assert registry["c"] is loader
+    registry.register("b", {"class": f"{__name__}:CountingLoader", "path": "/b2"})
+    assert registry["b"].dir == "/b2"
+
+
+def test_default_loaders_and_unknown_class():
+    registry = LoaderRegistry()
+    assert list(registry) == list(DEFAULT_LOADERS)
+    assert loader_class("Li_2018_CGI_Loader").__name__ == "Li_2018_CGI_Loader"
+    with pytest.raises(ValueError, match="Unknown loader class"):
+        loader_class("NoSuchLoader")
+
+
+@pytest.mark.parametrize("module", ["compute_iiw_whdr", "html"])
+def test_import_does_not_load_heavy_dependencies(module):
+    heavy = ["h5py", "skimage", "cv2", "torch", "scipy", "dominate"]
+    code = f"import sys, {module}; print(' '.join(m for m in {heavy!r} if m in sys.modules))"
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    loaded = subprocess.run([sys.executable, "-c", code], cwd=repo_dir, check=True, capture_output=True,
+                            text=True).stdout.split()
+    assert loaded == []
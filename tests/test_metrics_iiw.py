@@ -0,0 +1,221 @@
+import json
+
+import numpy as np
+import pytest
+
+import metrics_iiw
+
+
+def _compute_whdr_loop(reflectance, judgements, delta=0.1):
+    # the per-comparison loop compute_whdr was vectorized from
+    points = judgements['intrinsic_points']
+    comparisons = judgements['intrinsic_comparisons']
+    id_to_points = {p['id']: p for p in points}
+    rows, cols = reflectance.shape[0:2]
+
+    error_sum = 0.0
+    error_equal_sum = 0.0
+    error_inequal_sum = 0.0
+
+    weight_sum = 0.0
+    weight_equal_sum = 0.0
+    weight_inequal_sum = 0.0
+
+    for c in comparisons:
+        darker = c['darker']
+        if darker not in ('1', '2', 'E'):
+            continue
+
+        weight = c['darker_score']
+        if weight <= 0.0 or weight is None:
+            continue
+
+        point1 = id_to_points[c['point1']]
+        point2 = id_to_points[c['point2']]
+        if not point1['opaque'] or not point2['opaque']:
+            continue
+
+        l1 = max(1e-10, np.mean(reflectance[int(point1['y'] * rows), int(point1['x'] * cols), ...]))
+        l2 = max(1e-10, np.mean(reflectance[int(point2['y'] * rows), int(point2['x'] * cols), ...]))
+
+        if l2 / l1 > 1.0 + delta:
+            alg_darker = '1'
+        elif l1 / l2 > 1.0 + delta:
+            alg_darker = '2'
+        else:
+            alg_darker = 'E'
+
+        if darker == 'E':
+            if darker != alg_darker:
+                error_equal_sum += weight
+            weight_equal_sum += weight
+        else:
+            if darker != alg_darker:
+                error_inequal_sum += weight
+            weight_inequal_sum += weight
+
+        if darker != alg_darker:
+            error_sum += weight
+        weight_sum += weight
+
+    if weight_sum:
+        return (error_sum / weight_sum, weight_sum > 1e-5), \
+               (error_equal_sum / max(weight_equal_sum, 1e-6), weight_equal_sum > 1e-5), \
+               (error_inequal_sum / max(weight_inequal_sum, 1e-6), weight_inequal_sum > 1e-5)
+    else:
+        return None
+
+
+def random_judgements(rng, num_points=60, num_comparisons=300):
+    """IIW-style judgement json, including comparisons that the WHDR ignores"""
+    points = [{'id': 1000 + i, 'x': float(rng.uniform(0, 1)), 'y': float(rng.uniform(0, 1)),
+               'opaque': bool(rng.uniform() > 0.1)} for i in range(num_points)]
+    comparisons = []
+    for _ in range(num_comparisons):
+        p1, p2 = rng.choice(num_points, 2, replace=False)
+        comparisons.append({'point1': 1000 + int(p1), 'point2': 1000 + int(p2),
+                            'darker': str(rng.choice(['1', '2', 'E', 'E', 'X'])),
+                            'darker_score': float(rng.choice([0.0, -0.5, rng.uniform(0, 1), rng.uniform(0, 1)]))})
+    return {'intrinsic_points': points, 'intrinsic_comparisons': comparisons}
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("channels", [None, 1, 3])
+def test_compute_whdr_matches_loop(dtype, channels):
+    rng = np.random.default_rng(0)
+    shape = (37, 53) if channels is None else (37, 53, channels)
+    reflectance = rng.uniform(0, 1, shape).astype(dtype)
+    # zero luminance patches, clamped to 1e-10 by both versions
+    reflectance[:10, :20] = 0
+    for seed in range(5):
+        judgements = random_judgements(np.random.default_rng(seed))
+        for delta in [0.0, 0.1, 0.2]:
+            expected = _compute_whdr_loop(reflectance, judgements, delta)
+            assert metrics_iiw.compute_whdr(reflectance, judgements, delta) == expected
+            compiled = metrics_iiw.compile_judgements(judgements)
+            assert metrics_iiw.compute_whdr(reflectance, compiled, delta) == expected
+
+
+def test_compute_whdr_without_valid_comparisons():
+    rng = np.random.default_rng(1)
+    judgements = random_judgements(rng)
+    for c in judgements['intrinsic_comparisons']:
+        c['darker'] = 'X'
+    reflectance = rng.uniform(0, 1, (8, 8, 3))
+    assert _compute_whdr_loop(reflectance, judgements) is None
+    assert metrics_iiw.compute_whdr(reflectance, judgements) is None
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_evaluate_whdr_batched_matches_evaluate_whdr(tmp_path, dtype):
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("skimage")
+
+    rng = np.random.default_rng(2)
+    # smaller, larger and mixed original sizes than the 48x64 prediction, so
+    # the batch is both upsampled and anti-aliased while downsampled
+    original_shapes = [(120, 160), (30, 41), (24, 200)]
+    paths = []
+    for i in range(len(original_shapes)):
+        paths.append(str(tmp_path / f"{i}.json"))
+        with open(paths[-1], "w") as f:
+            json.dump(random_judgements(rng), f)
+    targets = {"oringinal_shape": (torch.tensor([s[0] for s in original_shapes]),
+                                   torch.tensor([s[1] for s in original_shapes])),
+               "judgements_path": paths}
+    # smooth enough that the ratios do not sit on the 1 + delta threshold
+    prediction_R = torch.as_tensor(rng.uniform(0.05, 1, (len(paths), 3, 48, 64)), dtype=getattr(torch, dtype))
+
+    judgement_store = metrics_iiw.JudgementCache()
+    expected = metrics_iiw.evaluate_WHDR(prediction_R, targets, judgement_store)
+    batched = metrics_iiw.evaluate_WHDR_batched(prediction_R, targets, judgement_store)
+    for (total, count), (expected_total, expected_count) in zip(batched, expected):
+        assert count == expected_count
+        assert total == pytest.approx(expected_total, abs=1e-9)
+
+
+@pytest.mark.parametrize("channels", [None, 3])
+def test_compute_whdr_sweep_matches_compute_whdr(channels):
+    rng = np.random.default_rng(3)
+    shape = (37, 53) if channels is None else (37, 53, channels)
+    reflectance = rng.uniform(0, 1, shape)
+    deltas = [0.0, 0.05, 0.1, 0.1, 0.2, 0.5]
+    for seed in range(5):
+        judgements = metrics_iiw.compile_judgements(random_judgements(np.random.default_rng(seed)))
+        expected = [metrics_iiw.compute_whdr(reflectance, judgements, delta) for delta in deltas]
+        assert metrics_iiw.compute_whdr_sweep(reflectance, judgements, deltas) == expected
+        sums = metrics_iiw.compute_whdr_sweep(reflectance, judgements, deltas, return_sums=True)
+        assert [metrics_iiw.whdr_from_sums(s) for s in sums] == expected
+
+
+def test_compute_whdr_sweep_matches_compute_whdr_sparse():
+    pytest.importorskip("skimage")
+    rng = np.random.default_rng(4)
+    prediction = rng.uniform(0.05, 1, (24, 32, 3))
+    deltas = [0.0, 0.1, 0.2]
+    for original_shape in [(45, 60), (18, 20)]:
+        for anti_aliasing in [False, True]:
+            judgements = metrics_iiw.compile_judgements(random_judgements(np.random.default_rng(5)))
+            expected = [metrics_iiw.compute_whdr_sparse(prediction, original_shape, judgements, delta,
+                                                        anti_aliasing=anti_aliasing) for delta in deltas]
+            assert metrics_iiw.compute_whdr_sweep(prediction, judgements, deltas, original_shape,
+                                                  anti_aliasing) == expected
+
+
+def _write_judgements(tmp_path, num_images, seed=6):
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(num_images):
+        paths.append(str(tmp_path / f"{i}.json"))
+        with open(paths[-1], "w") as f:
+            json.dump(random_judgements(rng), f)
+    return paths
+
+
+def test_judgement_cache_evicts_least_recently_used(tmp_path):
+    paths = _write_judgements(tmp_path, 4)
+    cache = metrics_iiw.JudgementCache(max_items=2)
+    first = cache.get_by_path(paths[0])
+    cache.get_by_path(paths[1])
+    assert cache.get_by_path(paths[0]) is first
+    cache.get_by_path(paths[2])
+    assert len(cache) == 2
+    # paths[1] was the least recently used
+    assert cache.get_by_path(paths[0]) is first
+    assert cache.entries.get(paths[1]) is None
+
+    nbytes = metrics_iiw._judgements_nbytes(first)
+    cache.set_limits(max_items=None, max_bytes=nbytes)
+    assert len(cache) == 1
+    for path in paths:
+        cache.get_by_path(path)
+        assert cache.entries.nbytes <= nbytes
+    cache.clear()
+    assert len(cache) == 0
+
+
+class _JsonLoader(object):
+    # parses the json on every call, as evaluate_WHDR did before the cache
+    def get_by_path(self, judgement_path):
+        with open(judgement_path) as f:
+            return json.load(f)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_evaluate_whdr_cached_matches_uncached(tmp_path, sparse):
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("skimage")
+
+    paths = _write_judgements(tmp_path, 3)
+    original_shapes = [(120, 160), (30, 41), (24, 200)]
+    targets = {"oringinal_shape": (torch.tensor([s[0] for s in original_shapes]),
+                                   torch.tensor([s[1] for s in original_shapes])),
+               "judgements_path": paths}
+    prediction_R = torch.as_tensor(np.random.default_rng(7).uniform(0.05, 1, (len(paths), 3, 48, 64)))
+
+    expected = metrics_iiw.evaluate_WHDR(prediction_R, targets, _JsonLoader(), sparse=sparse)
+    # a cache smaller than the batch evicts and parses again on the second pass
+    cache = metrics_iiw.JudgementCache(max_items=2)
+    for _ in range(2):
+        assert metrics_iiw.evaluate_WHDR(prediction_R, targets, cache, sparse=sparse) == expected
+    assert metrics_iiw.evaluate_WHDR(prediction_R, targets, sparse=sparse) == expected
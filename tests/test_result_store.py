@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+from prediction_loader import General_Loader, Luo_2020_NIID_Net_Loader
+from result_store import ResultStore
+from whdr_pipeline import evaluate_stream
+
+DELTAS = [0.1, 0.2]
+
+
+def _run(iiw_tree, store_path, **kwargs):
+    # (number of images taken from the store, {id: sums}) of a run over the tree
+    root, ids = iiw_tree
+    store = ResultStore(store_path)
+    loaders = {"luo": Luo_2020_NIID_Net_Loader(os.path.join(root, "luo"))}
+    results = list(evaluate_stream(ids, root, DELTAS, loaders, result_store=store, **kwargs))
+    store.save()
+    return sum(len(r.stored) for r in results), {r.id: r.sums for r in results}
+
+
+def test_rescore_only_changed_predictions(iiw_tree, tmp_path):
+    root, ids = iiw_tree
+    store_path = str(tmp_path / "results.npz")
+    num_stored, scored = _run(iiw_tree, store_path)
+    assert num_stored == 0
+    assert len(ResultStore(store_path)) == len(ids) * len(DELTAS)
+
+    num_stored, stored = _run(iiw_tree, store_path)
+    assert num_stored == len(ids)
+    assert stored == scored
+
+    # a touched prediction is scored again, with the same result
+    path = Luo_2020_NIID_Net_Loader(os.path.join(root, "luo")).get_pred_r_path(ids[3])
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    num_stored, rescored = _run(iiw_tree, store_path)
+    assert num_stored == len(ids) - 1
+    assert rescored == scored
+
+
+def test_mode_change_rescores(iiw_tree, tmp_path, capsys):
+    _, ids = iiw_tree
+    store_path = str(tmp_path / "results.npz")
+    _, dense = _run(iiw_tree, store_path)
+    num_stored, sparse = _run(iiw_tree, store_path, sparse=True)
+    assert num_stored == 0
+    assert "Stored results are for srgb dense, not srgb sparse" in capsys.readouterr().out
+    assert ResultStore(store_path).mode == "srgb sparse"
+    assert _run(iiw_tree, store_path, sparse=True) == (len(ids), sparse)
+    # the dense results were dropped with the mode change
+    assert _run(iiw_tree, store_path)[0] == 0
+
+
+def test_space_change_rescores(iiw_tree, tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    root, ids = iiw_tree
+    rng = np.random.default_rng(0)
+    for id in ids:
+        cv2.imwrite(str(tmp_path / f"{id}-r.png"), rng.integers(1, 256, (24, 32, 3), dtype=np.uint8))
+    loaders = {"general": General_Loader(str(tmp_path))}
+    store = ResultStore(str(tmp_path / "results.npz"))
+
+    def num_stored(space):
+        return sum(len(r.stored) for r in evaluate_stream(ids, root, DELTAS, loaders, space=space,
+                                                          result_store=store))
+
+    assert num_stored("srgb") == 0
+    assert num_stored("srgb") == len(ids)
+    assert num_stored("rgb") == 0
+    assert num_stored("rgb") == len(ids)
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+import util
+
+
+
+def _rgb_to_srgb_original(rgb):
+    # the implementation rgb_to_srgb was optimized from
+    ret = np.zeros_like(rgb)
+    idx0 = rgb <= 0.0031308
+    idx1 = rgb > 0.0031308
+    ret[idx0] = rgb[idx0] * 12.92
+    ret[idx1] = np.power(1.055 * rgb[idx1], 1.0 / 2.4) - 0.055
+    return ret
+
+
+def _linear_values(dtype):
+    rng = np.random.default_rng(0)
+    values = np.concatenate([rng.uniform(-0.1, 1.2, 10000), np.linspace(0.0031308 - 1e-6, 0.0031308 + 1e-6, 100),
+                             [0.0, -0.0, 0.0031308, 1.0, np.nan, np.inf, -np.inf]])
+    return values.astype(dtype).reshape(-1, 3)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_rgb_to_srgb_matches_original(dtype):
+    rgb = _linear_values(dtype)
+    expected = _rgb_to_srgb_original(rgb)
+    srgb = util.rgb_to_srgb(rgb)
+    assert srgb.dtype == expected.dtype
+    np.testing.assert_array_equal(srgb, expected)
+
+    # in place
+    copy = rgb.copy()
+    assert util.rgb_to_srgb(copy, out=copy) is copy
+    np.testing.assert_array_equal(copy, expected)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int32])
+def test_rgb_to_srgb_of_integers_uses_the_raw_values(dtype):
+    rgb = np.arange(0, 250, dtype=dtype).reshape(-1, 2)
+    with np.errstate(invalid="ignore"):
+        expected = _rgb_to_srgb_original(rgb)
+    srgb = util.rgb_to_srgb(rgb)
+    assert srgb.dtype == rgb.dtype
+    np.testing.assert_array_equal(srgb, expected)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_quantized_rgb_to_srgb(dtype):
+    levels = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    expected = util.rgb_to_srgb(levels / np.float64(np.iinfo(dtype).max))
+    srgb = util.quantized_rgb_to_srgb(levels)
+    assert srgb.dtype == np.float32
+    np.testing.assert_allclose(srgb, expected, rtol=1e-7, atol=1e-7)
+    out = np.empty(levels.shape, dtype=np.float64)
+    assert util.quantized_rgb_to_srgb(levels, out=out) is out
+    np.testing.assert_array_equal(out, srgb)
+    with pytest.raises(ValueError):
+        util.quantized_rgb_to_srgb(levels.astype(np.float32))
+
+
+def test_rgb_to_srgb_lut_error_bound():
+    assert util.rgb_to_srgb_lut_error() < 3.5e-3
+    # away from the knee only the 16 bit quantization counts
+    rgb = np.linspace(0.01, 1.0, 100000)
+    quantized = np.rint(rgb * 65535).astype(np.uint16)
+    assert np.abs(util.quantized_rgb_to_srgb(quantized) - util.rgb_to_srgb(rgb)).max() < 1.1e-4
+
+
+def test_srgb_to_rgb_round_trip():
+    rgb = np.concatenate([np.linspace(0.0, 1.0, 100001), np.linspace(0.003, 0.0036, 1001)])
+    srgb = util.rgb_to_srgb(rgb)
+    # gamma branch values that land below the linear branch's top, 0.0031308 * 12.92,
+    # are mapped back through the linear branch
+    ambiguous = (rgb > 0.0031308) & (srgb <= 0.0031308 * 12.92)
+    assert ambiguous.any()
+    np.testing.assert_allclose(util.srgb_to_rgb(srgb)[~ambiguous], rgb[~ambiguous], rtol=1e-12, atol=1e-15)
+    np.testing.assert_array_less(util.srgb_to_rgb(srgb)[ambiguous], 0.0031308 + 1e-15)
+
+    srgb = np.linspace(0.0, 1.0, 100001)
+    np.testing.assert_allclose(util.rgb_to_srgb(util.srgb_to_rgb(srgb)), srgb, rtol=1e-12, atol=1e-15)
+
+
+def test_srgb_to_linear_matches_standard_decoding():
+    srgb = np.linspace(0.0, 1.0, 10001)
+    expected = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    np.testing.assert_allclose(util.srgb_to_linear(srgb), expected, rtol=1e-14, atol=0)
+
+
+@pytest.mark.parametrize("output_shape", [(20, 30), (61, 47), (150, 200), (9, 7)])
+@pytest.mark.parametrize("anti_aliasing", [False, True])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_sample_resize_matches_resize(output_shape, anti_aliasing, dtype):
+    resize = pytest.importorskip("skimage.transform").resize
+    rng = np.random.default_rng(0)
+    image = rng.uniform(0, 1, (40, 60, 3)).astype(dtype)
+    expected = resize(image, output_shape, order=1, preserve_range=True, anti_aliasing=anti_aliasing)
+
+    rows, cols = np.meshgrid(np.arange(output_shape[0]), np.arange(output_shape[1]), indexing="ij")
+    rows, cols = rows.ravel(), cols.ravel()
+    samples = util.sample_resize(image, output_shape, rows, cols, anti_aliasing=anti_aliasing)
+    assert samples.dtype == expected.dtype
+    np.testing.assert_allclose(samples, expected[rows, cols], rtol=1e-5, atol=1e-6)
+
+
+def test_sample_resize_transform():
+    resize = pytest.importorskip("skimage.transform").resize
+    rng = np.random.default_rng(1)
+    image = rng.uniform(0, 1, (40, 60, 3))
+    expected = resize(util.rgb_to_srgb(image), (25, 35), order=1, preserve_range=True, anti_aliasing=True)
+    rows, cols = rng.integers(0, 25, 100), rng.integers(0, 35, 100)
+    samples = util.sample_resize(image, (25, 35), rows, cols, anti_aliasing=True, transform=util.rgb_to_srgb)
+    np.testing.assert_allclose(samples, expected[rows, cols], rtol=1e-10, atol=1e-12)
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import whdr_bootstrap
+from average_meter import WHDRAverageMeter
+from metrics_iiw import WHDRSums, whdr_from_sums
+
+
+def _image_sums(rng, num_images):
+    # per-image WHDRSums, including images without equal or inequal comparisons
+    weight_equal = rng.uniform(0, 5, num_images) * (rng.uniform(size=num_images) > 0.2)
+    weight_inequal = rng.uniform(0, 5, num_images) * (rng.uniform(size=num_images) > 0.2)
+    weight_inequal[weight_equal + weight_inequal == 0] = 1.0
+    error_equal = weight_equal * rng.uniform(size=num_images)
+    error_inequal = weight_inequal * rng.uniform(size=num_images)
+    return np.stack([error_equal + error_inequal, error_equal, error_inequal,
+                     weight_equal + weight_inequal, weight_equal, weight_inequal], axis=1)
+
+
+def _comparisons(rng, lengths):
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    weight = rng.uniform(0.1, 1, offsets[-1])
+    equal = rng.uniform(size=offsets[-1]) < 0.3
+    return (weight, equal, offsets), {"a": rng.uniform(size=offsets[-1]) < 0.2}
+
+
+def test_resample_counts():
+    counts = whdr_bootstrap._resample_counts(np.random.default_rng(0), 500, 37)
+    assert counts.shape == (500, 37)
+    assert (counts.sum(axis=1) == 37).all()
+    # every image is drawn once per resample on average
+    assert counts.mean() == pytest.approx(1.0)
+    assert counts.mean(axis=0) == pytest.approx(np.ones(37), abs=0.2)
+
+
+def test_aggregate_metrics_matches_meter():
+    sums = _image_sums(np.random.default_rng(1), 50)
+    meter = WHDRAverageMeter("test")
+    for s in sums:
+        meter.update_result(whdr_from_sums(WHDRSums(*s)))
+    expected = meter.get_results()
+    assert whdr_bootstrap.aggregate_metrics(sums, np.ones(len(sums))) == pytest.approx(list(expected), rel=1e-12)
+
+
+def test_paired_p_value_of_identical_methods():
+    sums = _image_sums(np.random.default_rng(2), 40)
+    samples = whdr_bootstrap.bootstrap({"a": sums, "b": sums.copy()}, num_resamples=200, seed=3)
+    assert (samples["a"] == samples["b"]).all()
+    assert whdr_bootstrap.paired_p_value(samples["a"][:, 0], samples["b"][:, 0]) == pytest.approx(1.0)
+
+    other = _image_sums(np.random.default_rng(4), 40)
+    other[:, 1:3] *= 0.2
+    other[:, 0] = other[:, 1] + other[:, 2]
+    samples = whdr_bootstrap.bootstrap({"a": sums, "b": other}, num_resamples=200, seed=3)
+    assert whdr_bootstrap.paired_p_value(samples["a"][:, 0], samples["b"][:, 0]) < 0.05
+
+
+def test_repeated_images_get_independent_comparison_draws():
+    rng = np.random.default_rng(5)
+    comparisons, errors = _comparisons(rng, [200, 150])
+    # image 0 drawn twice, in both resamples
+    images = np.array([[0, 0], [1, 0]])
+    sums = whdr_bootstrap._resample_comparison_sums(rng, images, comparisons, errors)["a"]
+    assert sums.shape == (2, 2, 6)
+    assert not np.array_equal(sums[0, 0], sums[0, 1])
+    # the weights of the drawn comparisons come from the drawn image only
+    weight, _, offsets = comparisons
+    for image, s in [(0, sums[0, 0]), (1, sums[1, 0])]:
+        image_weight = weight[offsets[image]:offsets[image + 1]]
+        length = len(image_weight)
+        assert image_weight.min() * length <= s[3] <= image_weight.max() * length
+
+
+def test_bootstrap_with_comparisons():
+    rng = np.random.default_rng(6)
+    comparisons, errors = _comparisons(rng, rng.integers(20, 60, 30))
+    weight, equal, offsets = comparisons
+    error = errors["a"]
+    sums = np.stack([np.add.reduceat(c, offsets[:-1]) for c in
+                     [weight * error, weight * (error & equal), weight * (error & ~equal),
+                      weight, weight * equal, weight * ~equal]], axis=1)
+    samples = whdr_bootstrap.bootstrap({"a": sums}, 2000, comparisons, errors, seed=7)["a"]
+    images_only = whdr_bootstrap.bootstrap({"a": sums}, 2000, seed=7)["a"]
+    point = whdr_bootstrap.aggregate_metrics(sums, np.ones(len(sums)))
+    assert samples.mean(axis=0) == pytest.approx(point, abs=0.01)
+    # resampling the comparisons too adds variance
+    assert samples[:, 0].std() > images_only[:, 0].std()
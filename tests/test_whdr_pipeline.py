@@ -0,0 +1,86 @@
+import os
+import random
+
+import pytest
+
+from average_meter import WHDRAverageMeter
+from prediction_loader import Li_2018_CGI_Loader, Luo_2020_NIID_Net_Loader
+from whdr_pipeline import _imap_bounded, aggregate_stage, evaluate_stream
+
+DELTAS = [0.1, 0.2]
+
+
+def _loaders(root):
+    return {"li": Li_2018_CGI_Loader(os.path.join(root, "li")),
+            "luo": Luo_2020_NIID_Net_Loader(os.path.join(root, "luo"), mmap_mode="r")}
+
+
+def _meters(iiw_tree, ids=None, **kwargs):
+    # state dicts of the {name: [WHDRAverageMeter per threshold]} of a run, with exact sums
+    root, all_ids = iiw_tree
+    loaders = _loaders(root)
+    meters = {name: [WHDRAverageMeter(f"{name}_{delta}") for delta in DELTAS] for name in loaders}
+    results = evaluate_stream(all_ids if ids is None else ids, root, DELTAS, loaders, **kwargs)
+    scored = [result.id for result in aggregate_stage(results, meters)]
+    return scored, {name: [m.state_dict() for m in ms] for name, ms in meters.items()}
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_prefetch_matches_serial(iiw_tree, sparse):
+    serial = _meters(iiw_tree, sparse=sparse)
+    assert serial[0] == iiw_tree[1]
+    assert _meters(iiw_tree, sparse=sparse, prefetch=3) == serial
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("max_pending", [1, 3, None])
+def test_workers_match_serial(iiw_tree, sparse, max_pending):
+    serial = _meters(iiw_tree, sparse=sparse)
+    assert _meters(iiw_tree, sparse=sparse, num_workers=2, max_pending=max_pending) == serial
+
+
+def test_meters_do_not_depend_on_the_image_order(iiw_tree):
+    ids = list(iiw_tree[1])
+    random.Random(0).shuffle(ids)
+    serial = _meters(iiw_tree)
+    scored, shuffled = _meters(iiw_tree, ids=iter(ids), num_workers=2, max_pending=2)
+    # results are yielded in the order of the ids, the exact sums do not depend on it
+    assert scored == ids
+    assert shuffled == serial[1]
+
+
+class _CountingPool(object):
+    # Pool stand-in that runs every task at once and counts the unfetched results
+    def __init__(self):
+        self.pending = 0
+        self.max_pending = 0
+
+    def apply_async(self, fn, args):
+        pool = self
+        pool.pending += 1
+        pool.max_pending = max(pool.max_pending, pool.pending)
+        value = fn(*args)
+
+        class Result(object):
+            def get(self):
+                pool.pending -= 1
+                return value
+        return Result()
+
+
+@pytest.mark.parametrize("max_pending", [1, 2, 5, 20])
+def test_imap_bounded_keeps_order_and_bound(max_pending):
+    pool = _CountingPool()
+    consumed = []
+
+    def items():
+        for i in range(10):
+            consumed.append(i)
+            yield i
+
+    results = _imap_bounded(pool, lambda x: x * x, items(), max_pending)
+    assert next(results) == 0
+    # the iterable is only read as far as the tasks in flight
+    assert len(consumed) == min(max_pending, 10)
+    assert list(results) == [i * i for i in range(1, 10)]
+    assert pool.max_pending == min(max_pending, 10)
@@ -1,10 +1,256 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
 
 
-def rgb_to_srgb(rgb):
-    ret = np.zeros_like(rgb)
-    idx0 = rgb <= 0.0031308
-    idx1 = rgb > 0.0031308
-    ret[idx0] = rgb[idx0] * 12.92
-    ret[idx1] = np.power(1.055 * rgb[idx1], 1.0 / 2.4) - 0.055
-    return ret
\ No newline at end of file
+def rgb_to_srgb(rgb, out=None):
+    """Linear RGB to sRGB, as used for all predictions in this repo.
+
+    The formula is applied to the values as they are, integer arrays included
+    (see quantized_rgb_to_srgb for linear values stored as uint8/uint16).
+    `out` is an optional output buffer, it may be `rgb` itself for an in-place
+    conversion.
+    """
+    rgb = np.asarray(rgb)
+    if rgb.dtype.kind != 'f':
+        # as the original implementation: the raw values, cast back to the input type
+        if out is None:
+            out = np.zeros_like(rgb)
+        out[...] = rgb_to_srgb(rgb.astype(np.float64))
+        return out
+
+    # the linear branch is evaluated first and the gamma branch in one pass over the
+    # whole array, so out may alias rgb
+    linear = ~(rgb > 0.0031308)
+    linear_values = rgb[linear] * 12.92
+    linear_values[np.isnan(linear_values)] = 0.0
+    if out is None:
+        out = np.empty_like(rgb)
+    with np.errstate(invalid='ignore'):
+        np.multiply(rgb, 1.055, out=out)
+        np.power(out, 1.0 / 2.4, out=out)
+        np.subtract(out, 0.055, out=out)
+    out[linear] = linear_values
+    return out
+
+
+def srgb_to_rgb(srgb, out=None):
+    """Inverse of rgb_to_srgb.
+
+    rgb_to_srgb is not continuous at 0.0031308 (the gamma branch applies the 1.055
+    factor before the power), so sRGB values in (0.0375, 0.04045] can come from
+    either branch; they are mapped back through the linear one. All other values
+    round-trip up to floating point rounding.
+    """
+    srgb = np.asarray(srgb)
+    if out is None:
+        out = np.zeros_like(srgb)
+    linear = srgb <= 0.0031308 * 12.92
+    gamma = srgb > 0.0031308 * 12.92
+    np.divide(srgb, 12.92, out=out, where=linear)
+    np.add(srgb, 0.055, out=out, where=gamma)
+    np.power(out, 2.4, out=out, where=gamma)
+    np.divide(out, 1.055, out=out, where=gamma)
+    return out
+
+
+def srgb_to_linear(srgb, out=None):
+    """Standard sRGB decoding, ((v + 0.055) / 1.055) ** 2.4 above 0.04045, as the
+    IIW code uses to read sRGB images. Unlike srgb_to_rgb, this is not the inverse
+    of rgb_to_srgb but of the encoding of externally produced sRGB images.
+    """
+    srgb = np.asarray(srgb)
+    if out is None:
+        out = np.zeros_like(srgb)
+    linear = srgb <= 0.04045
+    gamma = ~linear
+    np.divide(srgb, 12.92, out=out, where=linear)
+    np.add(srgb, 0.055, out=out, where=gamma)
+    np.divide(out, 1.055, out=out, where=gamma)
+    np.power(out, 2.4, out=out, where=gamma)
+    return out
+
+
+_srgb_luts = {}
+
+
+def _get_srgb_lut(bits):
+    if bits not in _srgb_luts:
+        levels = np.arange(2 ** bits, dtype=np.float64) / (2 ** bits - 1)
+        _srgb_luts[bits] = rgb_to_srgb(levels).astype(np.float32)
+    return _srgb_luts[bits]
+
+
+def quantized_rgb_to_srgb(rgb, out=None):
+    """rgb_to_srgb of linear values quantized to a uint8 or uint16 array, read as
+    v / (2**bits - 1), looked up in a table of the float32 results.
+
+    Meant for 8 and 16 bit sources; float arrays are faster converted directly
+    by rgb_to_srgb.
+    """
+    rgb = np.asarray(rgb)
+    if rgb.dtype == np.uint8:
+        table = _get_srgb_lut(8)
+    elif rgb.dtype == np.uint16:
+        table = _get_srgb_lut(16)
+    else:
+        raise ValueError(f"Expected a uint8 or uint16 array, not {rgb.dtype}")
+    if out is None:
+        out = np.empty(rgb.shape, dtype=np.float32)
+    if out.dtype == table.dtype:
+        np.take(table, rgb, out=out)
+    else:
+        out[...] = table[rgb]
+    return out
+
+
+def rgb_to_srgb_lut_error(num_samples=1000000):
+    """Largest absolute difference on [0, 1] between rgb_to_srgb and
+    quantized_rgb_to_srgb of the values rounded to 16 bits.
+
+    The quantization costs at most about 12.92 / 2**17 ~= 1e-4 (the steepest
+    slope times half a step). Inputs within half a step of the 0.0031308 knee
+    can also land on the other side of rgb_to_srgb's discontinuity, which bounds
+    the error by about 3e-3 there.
+    """
+    rgb = np.concatenate([np.linspace(0.0, 1.0, num_samples),
+                          np.linspace(0.0031308 - 2e-5, 0.0031308 + 2e-5, 1001)])
+    quantized = np.rint(rgb * 65535).astype(np.uint16)
+    return float(np.max(np.abs(quantized_rgb_to_srgb(quantized) - rgb_to_srgb(rgb))))
+
+
+def _mirror_index(idx, n):
+    # scipy.ndimage 'mirror' boundary, the mode skimage.transform.resize uses by default
+    if n == 1:
+        return np.zeros_like(idx)
+    period = 2 * (n - 1)
+    idx = np.abs(idx) % period
+    return np.where(idx > n - 1, period - idx, idx)
+
+
+def _gaussian_kernel1d(sigma, truncate=4.0):
+    # same kernel as scipy.ndimage.gaussian_filter
+    if sigma <= 1e-15:
+        return np.zeros(1, dtype=np.int64), np.ones(1)
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    k = np.exp(-0.5 / (sigma * sigma) * x ** 2)
+    return x, k / k.sum()
+
+
+def sample_resize(image, output_shape, rows, cols, anti_aliasing=False, transform=None):
+    """Values of resize(image, output_shape, order=1, preserve_range=True) at (rows, cols).
+
+    Only the pixels needed for the requested output positions are read, so
+    the cost depends on the number of samples instead of the image size, and
+    `image` may be a memory-mapped array. With anti_aliasing the gaussian
+    pre-filter of skimage's resize is applied to the neighbourhood of each
+    sample (it is a no-op when upsampling). `transform` is an elementwise
+    function applied to the pixels read from `image`, e.g. rgb_to_srgb, so
+    that the result equals resizing transform(image).
+    Returns an array of shape (len(rows),) + image.shape[2:].
+    """
+    in_h, in_w = image.shape[:2]
+    out_h, out_w = output_shape[:2]
+
+    # output pixel centers in input coordinates
+    r = (np.asarray(rows, dtype=np.float64) + 0.5) * (in_h / out_h) - 0.5
+    c = (np.asarray(cols, dtype=np.float64) + 0.5) * (in_w / out_w) - 0.5
+    r0 = np.floor(r).astype(np.int64)
+    c0 = np.floor(c).astype(np.int64)
+    fr = (r - r0).reshape((-1,) + (1,) * (image.ndim - 2))
+    fc = (c - c0).reshape((-1,) + (1,) * (image.ndim - 2))
+
+    dtypes = []
+
+    def read(ri, ci):
+        values = np.asarray(image[ri, ci])
+        if transform is not None:
+            values = transform(values)
+        dtypes.append(values.dtype)
+        return values.astype(np.float64)
+
+    if anti_aliasing:
+        kr, wr = _gaussian_kernel1d(max(0.0, (in_h / out_h - 1) / 2))
+        kc, wc = _gaussian_kernel1d(max(0.0, (in_w / out_w - 1) / 2))
+
+        def pixel(ri, ci):
+            ri = _mirror_index(ri[:, None, None] + kr[None, :, None], in_h)
+            ci = _mirror_index(ci[:, None, None] + kc[None, None, :], in_w)
+            return np.einsum('nij...,i,j->n...', read(ri, ci), wr, wc)
+    else:
+        def pixel(ri, ci):
+            return read(_mirror_index(ri, in_h), _mirror_index(ci, in_w))
+
+    ret = (1 - fr) * (1 - fc) * pixel(r0, c0) + (1 - fr) * fc * pixel(r0, c0 + 1) \
+        + fr * (1 - fc) * pixel(r0 + 1, c0) + fr * fc * pixel(r0 + 1, c0 + 1)
+    # resize keeps float32 inputs in float32 and returns float64 otherwise
+    return ret.astype(np.float32 if dtypes[0] in (np.float16, np.float32) else np.float64)
+
+
+class ByteLRUCache(object):
+    """Thread-safe LRU mapping bounded by the total size of its values.
+
+    `sizeof(value)` gives the bytes a value is charged for. The cache holds at
+    most `max_bytes` bytes and at most `max_items` entries (either limit is off
+    if None); the least recently used entries are evicted first.
+    """
+
+    def __init__(self, sizeof, max_bytes=None, max_items=None):
+        self.sizeof = sizeof
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # a copy, e.g. in a worker process, starts empty with the same limits
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["entries"] = OrderedDict()
+        state["nbytes"] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, default)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= self.sizeof(previous)
+            self.entries[key] = value
+            self.nbytes += self.sizeof(value)
+            self._evict()
+
+    def set_limits(self, max_bytes=None, max_items=None):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.max_items = max_items
+            self._evict()
+
+    def _evict(self):
+        # the most recent entry is always kept
+        while len(self.entries) > 1 and (
+                (self.max_items is not None and len(self.entries) > self.max_items)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.sizeof(evicted)
@@ -0,0 +1,222 @@
+import numpy as np
+
+from metrics_iiw import DARKER_CODES
+
+METRICS = ["WHDR", "WHDR_eq", "WHDR_ineq"]
+
+
+def image_metrics(sums):
+    """Vectorized metrics_iiw.whdr_from_sums over WHDRSums stacked in the last axis of
+    `sums`: the per-image WHDR, WHDR_eq and WHDR_ineq and whether the latter two are valid"""
+    error, error_equal, error_inequal, weight, weight_equal, weight_inequal = np.moveaxis(sums, -1, 0)
+    whdr = error / weight
+    whdr_eq = error_equal / np.maximum(weight_equal, 1e-6)
+    whdr_ineq = error_inequal / np.maximum(weight_inequal, 1e-6)
+    return whdr, whdr_eq, whdr_ineq, weight_equal > 1e-5, weight_inequal > 1e-5
+
+
+def aggregate_metrics(sums, counts):
+    """WHDR, WHDR_eq and WHDR_ineq (last axis) of the test list mean, as computed by
+    WHDRAverageMeter, with image i counted counts[..., i] times"""
+    whdr, whdr_eq, whdr_ineq, valid_eq, valid_ineq = image_metrics(sums)
+    counts = counts.astype(np.float64)
+    total = counts.sum(axis=-1)
+    with np.errstate(invalid="ignore"):
+        return np.stack([(counts * whdr).sum(axis=-1) / total,
+                         (counts * np.where(valid_eq, whdr_eq, 0)).sum(axis=-1) / (counts * valid_eq).sum(axis=-1),
+                         (counts * np.where(valid_ineq, whdr_ineq, 0)).sum(axis=-1)
+                         / (counts * valid_ineq).sum(axis=-1)], axis=-1)
+
+
+def _resample_images(rng, num_resamples, num_images):
+    # the images drawn with replacement by every resample, (num_resamples, num_images)
+    return rng.integers(0, num_images, (num_resamples, num_images))
+
+
+def _resample_counts(rng, num_resamples, num_images):
+    # how often each image is drawn in every resample, (num_resamples, num_images)
+    draws = _resample_images(rng, num_resamples, num_images)
+    draws += np.arange(num_resamples)[:, None] * num_images
+    return np.bincount(draws.ravel(), minlength=num_resamples * num_images).reshape(num_resamples, num_images)
+
+
+def _resample_comparison_sums(rng, images, comparisons, errors):
+    # WHDRSums of every drawn image, (num_resamples, num_images, 6) for every method,
+    # with the comparisons of each draw of `images` (see _resample_images) drawn with
+    # replacement from that image, independently for every time it is drawn. The
+    # draws form a sparse (draw, comparison) count matrix, and a single product
+    # with the weighted flags of all methods sums them.
+    from scipy import sparse
+    weight, equal, offsets = comparisons
+    lengths = np.diff(offsets)
+    num_resamples, num_images = images.shape
+    num_comparisons = len(weight)
+    draw_lengths = lengths[images.ravel()]
+    num_draws = int(draw_lengths.sum())
+    index_dtype = np.int32 if max(num_draws, num_comparisons) < 2 ** 31 else np.int64
+    # float32 uniforms in [0, 1) times a length below 2**24 stay below the length.
+    # Repeating the narrow types is much cheaper than converting after the repeat
+    draws = rng.random(num_draws, dtype=np.float32)
+    draws *= np.repeat(draw_lengths.astype(np.float32), draw_lengths)
+    index = draws.astype(index_dtype)
+    index += np.repeat(offsets[:-1].astype(index_dtype)[images.ravel()], draw_lengths)
+    indptr = np.concatenate([[0], np.cumsum(draw_lengths)]).astype(index_dtype)
+    counts = sparse.csr_matrix((np.ones(num_draws), index, indptr), shape=(images.size, num_comparisons))
+
+    names = list(errors)
+    columns = [weight * equal, weight * ~equal]
+    for name in names:
+        columns += [weight * (errors[name] & equal), weight * (errors[name] & ~equal)]
+    totals = (counts @ np.stack(columns, axis=1)).reshape(num_resamples, num_images, len(columns))
+    weight_equal, weight_inequal = totals[..., 0], totals[..., 1]
+    sums = {}
+    for k, name in enumerate(names):
+        error_equal, error_inequal = totals[..., 2 + 2 * k], totals[..., 3 + 2 * k]
+        sums[name] = np.stack([error_equal + error_inequal, error_equal, error_inequal,
+                               weight_equal + weight_inequal, weight_equal, weight_inequal], axis=-1)
+    return sums
+
+
+def bootstrap(method_sums, num_resamples=10000, comparisons=None, errors=None, seed=0, max_bytes=256 * 2 ** 20):
+    """Bootstrap distribution of WHDR, WHDR_eq and WHDR_ineq of every method.
+
+    `method_sums` is {name: (num_images, 6) array of per-image WHDRSums}, all over
+    the same images. Every resample draws the images with replacement, the same
+    draw for all methods so their differences are paired. If `comparisons` =
+    (weight, equal, offsets) of the concatenated comparisons of all images (see
+    BootstrapCollector) and `errors` = {name: per comparison error flags} are
+    given, the comparisons of the drawn images are resampled too; an image drawn
+    k times gets k independent draws of its comparisons.
+    Returns {name: (num_resamples, 3) array}.
+    """
+    rng = np.random.default_rng(seed)
+    names = list(method_sums)
+    num_images = len(method_sums[names[0]])
+    if comparisons is None:
+        per_resample = num_images * 8 * 3
+    else:
+        per_resample = len(comparisons[0]) * 8 * 6
+    chunk = int(max(1, min(num_resamples, max_bytes // per_resample)))
+
+    samples = {name: [] for name in names}
+    for start in range(0, num_resamples, chunk):
+        n = min(chunk, num_resamples - start)
+        if comparisons is None:
+            counts = _resample_counts(rng, n, num_images)
+            for name in names:
+                samples[name].append(aggregate_metrics(method_sums[name][None], counts))
+        else:
+            # every draw of an image is one entry, with comparisons of its own
+            resampled = _resample_comparison_sums(rng, _resample_images(rng, n, num_images), comparisons, errors)
+            for name in names:
+                samples[name].append(aggregate_metrics(resampled[name], np.ones(num_images)))
+    return {name: np.concatenate(s) for name, s in samples.items()}
+
+
+def confidence_interval(samples, level=0.95):
+    """Percentile interval of the bootstrap samples, (lower, upper) along the last axis"""
+    alpha = (1.0 - level) / 2
+    return np.nanquantile(samples, [alpha, 1.0 - alpha], axis=0)
+
+
+def paired_p_value(samples_a, samples_b):
+    """Two-sided bootstrap p-value of the paired difference a - b being zero"""
+    diff = samples_a - samples_b
+    num = np.sum(~np.isnan(diff), axis=0)
+    below = np.sum(diff <= 0, axis=0)
+    above = np.sum(diff >= 0, axis=0)
+    return np.minimum(1.0, 2 * (np.minimum(below, above) + 1) / (num + 1))
+
+
+class BootstrapCollector(object):
+    """Collects the per-image results of whdr_pipeline.evaluate_stream for bootstrap.
+
+    Pass `add` as the on_result callback of compute_iiw_whdr.evaluate_ids. With
+    a judgement store and results scored with keep_errors, the comparisons of
+    every image are kept as well, for resampling within images. The methods are
+    compared on the same images, so with the method `names` given, images that
+    some of them skipped are left out.
+    """
+
+    def __init__(self, deltas, judgement_store=None, names=None):
+        self.deltas = deltas
+        self.judgement_store = judgement_store
+        self.names = names
+        self.num_incomplete = 0
+        self.ids = []
+        self.sums = {}
+        self.errors = {}
+        self.weight, self.equal = [], []
+
+    @property
+    def has_comparisons(self):
+        return self.judgement_store is not None and len(self.errors) > 0
+
+    def add(self, result):
+        if self.names is not None and any(name not in result.sums for name in self.names):
+            self.num_incomplete += 1
+            return
+        self.ids.append(result.id)
+        for name, sums in result.sums.items():
+            self.sums.setdefault(name, []).append(sums)
+        if result.errors is not None and self.judgement_store is not None:
+            judgements = self.judgement_store.get(result.id)
+            self.weight.append(judgements.weight)
+            self.equal.append(judgements.darker == DARKER_CODES['E'])
+            for name, errors in result.errors.items():
+                self.errors.setdefault(name, []).append(errors)
+
+    def run(self, num_resamples=10000, within_images=False, seed=0):
+        """{threshold: {name: (num_resamples, 3) samples}}"""
+        if within_images and not self.has_comparisons:
+            raise ValueError("Resampling comparisons needs results scored with keep_errors and a judgement store")
+        comparisons = None
+        if within_images:
+            lengths = [len(w) for w in self.weight]
+            comparisons = (np.concatenate(self.weight), np.concatenate(self.equal),
+                           np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+
+        results = {}
+        for k, delta in enumerate(self.deltas):
+            method_sums = {name: np.array([s[k] for s in sums], dtype=np.float64) for name, sums in self.sums.items()}
+            errors = None
+            if within_images:
+                errors = {name: np.concatenate([e[k] for e in image_errors])
+                          for name, image_errors in self.errors.items()}
+            results[delta] = bootstrap(method_sums, num_resamples, comparisons, errors, seed)
+        return results
+
+
+def print_bootstrap_report(collector, num_resamples=10000, within_images=False, seed=0, level=0.95):
+    """Confidence intervals of every method and p-values of the WHDR difference of every pair"""
+    point = {delta: {name: aggregate_metrics(np.array([s[k] for s in sums]), np.ones(len(sums)))
+                     for name, sums in collector.sums.items()}
+             for k, delta in enumerate(collector.deltas)}
+    samples = collector.run(num_resamples, within_images, seed)
+    names = list(collector.sums)
+    width = max([len("method")] + [len(name) for name in names])
+
+    print(f"\nBootstrap ({num_resamples} resamples of {len(collector.ids)} images"
+          f"{' and their comparisons' if within_images else ''}), {level:.0%} intervals")
+    if collector.num_incomplete:
+        print(f"Left out {collector.num_incomplete} images without the results of every method")
+    print(f"{'method':<{width}} {'threshold':>10} " + " ".join(f"{m:>28}" for m in METRICS))
+    for delta, method_samples in samples.items():
+        for name in names:
+            low, high = confidence_interval(method_samples[name], level)
+            cells = [f"{point[delta][name][i]:.6f} [{low[i]:.6f}, {high[i]:.6f}]" for i in range(len(METRICS))]
+            print(f"{name:<{width}} {delta:>10.4f} " + " ".join(f"{c:>28}" for c in cells))
+
+    if len(names) < 2:
+        return
+    print("\nPaired differences of WHDR")
+    print(f"{'method a - method b':<{2 * width + 3}} {'threshold':>10} {'diff':>10} {'interval':>24} {'p':>8}")
+    for delta, method_samples in samples.items():
+        for i, a in enumerate(names):
+            for b in names[i + 1:]:
+                diff = method_samples[a][:, 0] - method_samples[b][:, 0]
+                low, high = confidence_interval(diff, level)
+                p = paired_p_value(method_samples[a][:, 0], method_samples[b][:, 0])
+                print(f"{a + ' - ' + b:<{2 * width + 3}} {delta:>10.4f} "
+                      f"{point[delta][a][0] - point[delta][b][0]:>10.6f} "
+                      f"{f'[{low:.6f}, {high:.6f}]':>24} {p:>8.4f}")
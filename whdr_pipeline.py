@@ -0,0 +1,297 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import image_cache
+import metrics_iiw
+from average_meter import StageTimer, null_timer
+from image_meta import read_image_size
+
+# judgements, original (height, width) and {loader name: (prediction, pixel transform)} of one image,
+# and the names of the loaders scored at the resolution of their prediction (see
+# PredictionLoader.native_resolution)
+ImageItem = namedtuple("ImageItem", ["id", "judgements", "original_shape", "predictions", "native"],
+                       defaults=[()])
+# {loader name: [metrics_iiw.WHDRSums per threshold]} of one image, if requested
+# {loader name: [per comparison error flags per threshold]}, the names of the
+# loaders whose sums were taken from a ResultStore and of those skipped for lack
+# of a prediction file (see PredictionLoader.skip_missing)
+ImageResult = namedtuple("ImageResult", ["id", "sums", "errors", "stored", "skipped"], defaults=[None, (), ()])
+# an image of evaluate_stream: the loaders still to score, {name: stored sums} of the
+# others, ({name: prediction key}, judgement key) for the ResultStore and the skipped loaders
+_Task = namedtuple("_Task", ["id", "names", "stored", "keys", "skipped"])
+
+
+def _to_id(entry):
+    # "123", "123.png" and ".../123.png.h5" all name image 123
+    return os.path.basename(entry.strip()).split('.')[0]
+
+
+def read_ids(source):
+    """Image ids, one at a time, from a test list pickle (.p/.pkl), a text file with
+    one id or image path per line, "-" for stdin, or any iterable of ids or paths"""
+    if not isinstance(source, str):
+        for entry in source:
+            yield _to_id(entry)
+        return
+    if source == "-":
+        lines = sys.stdin
+    elif source.endswith((".p", ".pkl")):
+        import pickle
+        with open(source, "rb") as f:
+            buckets = pickle.load(f)
+        for img_list in buckets:
+            for path in img_list:
+                yield _to_id(path)
+        return
+    else:
+        lines = open(source)
+    try:
+        for line in lines:
+            if line.strip() and not line.lstrip().startswith('#'):
+                yield _to_id(line)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def load_stage(ids, iiw_dir, loaders, judgement_store=None, image_sizes=None, sparse=False, timer=null_timer,
+               space="srgb"):
+    """ImageItem of every id: its judgements, original size and the prediction of each
+    loader in color `space`.
+
+    With `sparse` the predictions are left as returned by get_pred_r_lazy, for
+    sampling at the judgement points only.
+    """
+    for id in ids:
+        img_path = os.path.join(iiw_dir, "data", f"{id}.png")
+        with timer.stage("judgements"):
+            if judgement_store is not None:
+                judgements = judgement_store.get(id)
+            else:
+                with open(os.path.join(iiw_dir, "data", f"{id}.json")) as f:
+                    judgements = metrics_iiw.compile_judgements(json.load(f))
+
+        with timer.stage("image_size"):
+            if image_sizes is not None:
+                original_shape = image_sizes.get(id, img_path)
+            else:
+                original_shape = read_image_size(img_path)
+
+        predictions = {}
+        with timer.stage("load"):
+            for name, loader in loaders.items():
+                if sparse:
+                    predictions[name] = loader.get_pred_r_lazy(id, space)
+                else:
+                    predictions[name] = (loader.get_pred_r(id, space), None)
+        native = tuple(name for name, loader in loaders.items() if loader.native_resolution)
+        yield ImageItem(id, judgements, tuple(original_shape), predictions, native)
+
+
+def preprocess_stage(items, sparse=False, timer=null_timer):
+    """Resize the predictions to the original image size, unless `sparse` or
+    scored at their own resolution"""
+    if not sparse:
+        from skimage.transform import resize
+    for item in items:
+        if not sparse:
+            with timer.stage("resize"):
+                predictions = {name: (pred_r if name in item.native else
+                                      resize(pred_r, item.original_shape,
+                                             order=1, preserve_range=True, anti_aliasing=True), None)
+                               for name, (pred_r, _) in item.predictions.items()}
+            item = item._replace(predictions=predictions)
+        yield item
+
+
+def score_stage(items, deltas, sparse=False, timer=null_timer, keep_errors=False):
+    """ImageResult with the WHDRSums of every prediction and threshold in `deltas`,
+    and with keep_errors the error flags of the individual comparisons"""
+    for item in items:
+        sums, errors = {}, {}
+        with timer.stage("whdr"):
+            for name, (pred_r, transform) in item.predictions.items():
+                if sparse:
+                    # sampling at the prediction's own size reads its pixels unchanged
+                    shape = pred_r.shape[:2] if name in item.native else item.original_shape
+                    judgements, ratio21, ratio12 = metrics_iiw.judgement_ratios(
+                        pred_r, item.judgements, shape, anti_aliasing=True, transform=transform)
+                else:
+                    judgements, ratio21, ratio12 = metrics_iiw.judgement_ratios(pred_r, item.judgements)
+                sums[name] = [metrics_iiw.whdr_sums_from_ratios(ratio21, ratio12, judgements, delta)
+                              for delta in deltas]
+                if keep_errors:
+                    errors[name] = [metrics_iiw.comparison_errors(ratio21, ratio12, judgements, delta)
+                                    for delta in deltas]
+        yield ImageResult(item.id, sums, errors if keep_errors else None)
+
+
+def aggregate_stage(results, meters):
+    """Add every ImageResult to the {loader name: [WHDRAverageMeter per threshold]}
+    `meters` and pass it on"""
+    for result in results:
+        for name, sums in result.sums.items():
+            for meter, s in zip(meters[name], sums):
+                meter.update_result(metrics_iiw.whdr_from_sums(s))
+        yield result
+
+
+def score_ids(ids, iiw_dir, deltas, loaders, judgement_store=None, sparse=False, image_sizes=None,
+              timer=null_timer, keep_errors=False, space="srgb"):
+    """load_stage, preprocess_stage and score_stage chained over `ids`"""
+    items = load_stage(ids, iiw_dir, loaders, judgement_store, image_sizes, sparse, timer, space)
+    return score_stage(preprocess_stage(items, sparse, timer), deltas, sparse, timer, keep_errors)
+
+
+def _judgement_key(id, iiw_dir, judgement_store):
+    # mtime and size of the judgement file the comparisons of `id` are read from
+    if judgement_store is not None:
+        return judgement_store.get_key(id)
+    st = os.stat(os.path.join(iiw_dir, "data", f"{id}.json"))
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def _tasks(ids, iiw_dir, deltas, loaders, judgement_store, result_store):
+    # _Task of every id
+    for id in ids:
+        # get_pred_key is None if the prediction file does not exist
+        keys = {name: loader.get_pred_key(id) for name, loader in loaders.items()
+                if result_store is not None or loader.skip_missing}
+        skipped = tuple(name for name, loader in loaders.items() if loader.skip_missing and keys[name] is None)
+        names = [name for name in loaders if name not in skipped]
+        if result_store is None:
+            yield _Task(id, names, {}, None, skipped)
+            continue
+        judgement_key = _judgement_key(id, iiw_dir, judgement_store)
+        stored = {}
+        for name in names:
+            sums = [result_store.get(name, delta, id, keys[name], judgement_key) for delta in deltas]
+            if all(s is not None for s in sums):
+                stored[name] = sums
+        yield _Task(id, [name for name in names if name not in stored], stored, (keys, judgement_key), skipped)
+
+
+def _load_task(task, iiw_dir, loaders, judgement_store, image_sizes, sparse, timed, space):
+    # ImageItem of the loaders a task still has to score, and the StageTimer of the task
+    timer = StageTimer() if timed else null_timer
+    if not task.names:
+        return ImageItem(task.id, None, None, {}), timer
+    item, = load_stage([task.id], iiw_dir, {name: loaders[name] for name in task.names}, judgement_store,
+                       image_sizes, sparse, timer, space)
+    return item, timer
+
+
+def _score_item(task, item, timer, deltas, sparse, timed, keep_errors):
+    result, = score_stage(preprocess_stage([item], sparse, timer), deltas, sparse, timer, keep_errors)
+    return task, result, timer if timed else None
+
+
+def _score_task(task, iiw_dir, deltas, loaders, judgement_store, sparse, image_sizes, timed, keep_errors, space):
+    item, timer = _load_task(task, iiw_dir, loaders, judgement_store, image_sizes, sparse, timed, space)
+    return _score_item(task, item, timer, deltas, sparse, timed, keep_errors)
+
+
+# arguments of _score_task shared by all tasks of a worker process
+_worker_args = None
+
+
+def _init_worker(default_image_cache, *args):
+    global _worker_args
+    # only forked workers inherit the cache set by image_cache.set_default_cache
+    image_cache.set_default_cache(default_image_cache)
+    _worker_args = args
+
+
+def _score_task_worker(task):
+    return _score_task(task, *_worker_args)
+
+
+def _imap_bounded(pool, fn, iterable, max_pending):
+    # unlike Pool.imap, which consumes the whole iterable up front, keep at most
+    # max_pending tasks in flight
+    pending = deque()
+    for x in iterable:
+        pending.append(pool.apply_async(fn, (x,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _score_prefetched(executor, tasks, num_ahead, args):
+    # _score_task, with the tasks loaded up to num_ahead ahead on the executor threads
+    iiw_dir, deltas, loaders, judgement_store, sparse, image_sizes, timed, keep_errors, space = args
+    pending = deque()
+    for task in tasks:
+        pending.append((task, executor.submit(_load_task, task, iiw_dir, loaders, judgement_store, image_sizes,
+                                              sparse, timed, space)))
+        if len(pending) > num_ahead:
+            task, future = pending.popleft()
+            yield _score_item(task, *future.result(), deltas, sparse, timed, keep_errors)
+    while pending:
+        task, future = pending.popleft()
+        yield _score_item(task, *future.result(), deltas, sparse, timed, keep_errors)
+
+
+def _merge_stored(task, result, deltas, loaders, result_store):
+    # store the scored sums and add the stored ones, in the order of `loaders`
+    result = result._replace(skipped=task.skipped)
+    if result_store is None:
+        return result
+    keys, judgement_key = task.keys
+    for name, sums in result.sums.items():
+        for delta, s in zip(deltas, sums):
+            result_store.put(name, delta, task.id, keys[name], judgement_key, s)
+    if not task.stored:
+        return result
+    sums = {name: task.stored[name] if name in task.stored else result.sums[name]
+            for name in loaders if name not in task.skipped}
+    return result._replace(sums=sums, stored=tuple(task.stored))
+
+
+def evaluate_stream(ids, iiw_dir, deltas, loaders, judgement_store=None, sparse=False, image_sizes=None,
+                    num_workers=1, max_pending=None, timer=null_timer, keep_errors=False, space="srgb",
+                    result_store=None, prefetch=0):
+    """ImageResult of every id of the iterable `ids`, yielded in order as it is scored.
+
+    Ids are read lazily and at most one image (serial), `prefetch` images or
+    `max_pending` images (num_workers > 1, default 4 per worker) are held at a
+    time, so memory does not grow with the length of the id list. Worker
+    processes cannot add to `image_sizes`; new entries are only recorded by
+    serial runs. With a ResultStore, every scored result is put into it and the
+    results of unchanged predictions (see PredictionLoader.get_pred_key) and
+    judgements, scored in the same space and sparse mode, are taken from it
+    instead; their loaders are listed in ImageResult.stored. Loaders with
+    skip_missing leave out the images without a prediction file, they are listed
+    in ImageResult.skipped. In a serial run, prefetch > 0 loads that many images
+    ahead on background threads.
+    """
+    if result_store is not None and keep_errors:
+        raise ValueError("Stored results have no per comparison errors, use keep_errors without a result store")
+    if prefetch > 0 and num_workers > 1:
+        raise ValueError("prefetch only applies to serial runs, every worker process loads its own images")
+    if result_store is not None:
+        result_store.set_mode(f"{space} {'sparse' if sparse else 'dense'}")
+    tasks = _tasks(ids, iiw_dir, deltas, loaders, judgement_store, result_store)
+    args = (iiw_dir, deltas, loaders, judgement_store, sparse, image_sizes, timer is not null_timer, keep_errors,
+            space)
+    with contextlib.ExitStack() as stack:
+        if num_workers > 1:
+            pool = stack.enter_context(multiprocessing.Pool(processes=num_workers, initializer=_init_worker,
+                                                            initargs=(image_cache.get_default_cache(),) + args))
+            scored = _imap_bounded(pool, _score_task_worker, tasks,
+                                   max_pending if max_pending is not None else num_workers * 4)
+        elif prefetch > 0:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=min(prefetch, 4)))
+            scored = _score_prefetched(executor, tasks, prefetch, args)
+        else:
+            scored = (_score_task(task, *args) for task in tasks)
+        for task, result, task_timer in scored:
+            if task_timer is not None:
+                timer.merge(task_timer)
+            yield _merge_stored(task, result, deltas, loaders, result_store)